@@ -111,7 +111,8 @@ if prompt := st.chat_input("Enter a song name (e.g., 'Shape of You' or 'Bohemian
                 "pipeline_step": "",
                 "video_path": "",
                 "current_step": "starting",
-                "vocal_volume": st.session_state.vocal_volume
+                "vocal_volume": st.session_state.vocal_volume,
+                "full_quality_job": ""
             }
             
             # Run the graph with streaming
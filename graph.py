@@ -1,4 +1,6 @@
 import os
+import threading
+import uuid
 from dotenv import load_dotenv
 from typing import TypedDict, Annotated
 from langgraph.graph import StateGraph, END
@@ -22,11 +24,20 @@ class KaraokeState(TypedDict):
     video_path: str
     current_step: str
     vocal_volume: float 
+    full_quality_job: str  # key of this request's background full-quality separation, if any
 
 
 # Initialize the LLM
 llm = ChatOpenAI(model="gpt-4o", temperature=0)
 
+# Seconds of the song separated for the preview video; 0 separates the whole song up front
+PREVIEW_SECONDS = float(os.getenv("SEPARATION_PREVIEW_SECONDS", "0"))
+
+# Background full-quality separations of requests whose pipeline ran on a preview,
+# keyed per request so that two requests for the same song keep their own job
+_full_quality_jobs = {}
+_full_quality_lock = threading.Lock()
+
 
 def extract_song_info(state: KaraokeState) -> KaraokeState:
     """Extract song information AND artist name from user query"""
@@ -156,14 +167,27 @@ def pipeline_vocal_separation(state: KaraokeState) -> KaraokeState:
     from utils.utils import vocal_separation
     
     song_name = state["song_name"]
+    vocal_volume = state.get("vocal_volume", 0.0)
+    full_quality_job = ""
     try:
         print(f"[Pipeline] Separating vocals for '{song_name}'...")
-        vocal_separation(song_name)
-        print(f"[Pipeline] ✓ Vocal separation completed")
+        # Writes the karaoke mix directly, so the merging step has nothing left to do
+        if PREVIEW_SECONDS > 0:
+            full_separation = vocal_separation(
+                song_name, vocal_volume=vocal_volume, preview_seconds=PREVIEW_SECONDS
+            )
+            full_quality_job = f"{song_name}-{uuid.uuid4().hex}"
+            with _full_quality_lock:
+                _full_quality_jobs[full_quality_job] = full_separation
+            print(f"[Pipeline] ✓ Preview vocal separation completed, full quality running in background")
+        else:
+            vocal_separation(song_name, vocal_volume=vocal_volume)
+            print(f"[Pipeline] ✓ Vocal separation completed")
         
         return {
             **state,
             "current_step": "vocal_separated",
+            "full_quality_job": full_quality_job,
             "messages": state["messages"] + [AIMessage(content="✓ Separating vocals completed")]
         }
     except Exception as e:
@@ -295,9 +319,13 @@ def pipeline_audio_merging(state: KaraokeState) -> KaraokeState:
     song_name = state["song_name"]
     vocal_volume = state.get("vocal_volume", 0.0)
     try:
-        print(f"[Pipeline] Merging audio for '{song_name}'...")
-        merge_audio(song_name=song_name, volume_factor=vocal_volume)
-        print(f"[Pipeline] ✓ Audio merging completed")
+        merged_path = os.path.join(os.getcwd(), 'processed_songs', song_name, f'{song_name}_Merged.wav')
+        if os.path.exists(merged_path):
+            print(f"[Pipeline] ✓ Karaoke mix already written by vocal separation")
+        else:
+            print(f"[Pipeline] Merging audio for '{song_name}'...")
+            merge_audio(song_name=song_name, volume_factor=vocal_volume)
+            print(f"[Pipeline] ✓ Audio merging completed")
         
         return {
             **state,
@@ -341,6 +369,28 @@ def pipeline_video_creation(state: KaraokeState) -> KaraokeState:
         }
 
 
+def refine_full_quality(state: KaraokeState, full_separation) -> None:
+    """Swap in the full-quality stems and re-run the steps after vocal separation"""
+    import sys
+    sys.path.append('./utils/')
+    from utils.utils import promote_full_quality
+
+    song_name = state["song_name"]
+    staged_paths = full_separation.result()
+    # the preview video is rendered by now, so nothing reads the preview stems
+    promote_full_quality(song_name, staged_paths)
+    print(f"[Refine] Full-quality stems ready for '{song_name}', regenerating the video...")
+
+    refined = {**state, "current_step": "vocal_separated"}
+    for step in (pipeline_transcription, pipeline_timestamp_correction, validate_timestamps,
+                 pipeline_image_generation, pipeline_audio_merging, pipeline_video_creation):
+        refined = step(refined)
+        if refined["current_step"] == "error":
+            print(f"[Refine] {refined['messages'][-1].content}")
+            return
+    print(f"[Refine] ✓ Full-quality video replaced the preview for '{song_name}'")
+
+
 def finalize_agent(state: KaraokeState) -> KaraokeState:
     """Agent that checks and finalizes the video"""
     song_name = state["song_name"]
@@ -366,11 +416,19 @@ def finalize_agent(state: KaraokeState) -> KaraokeState:
     else:
         video_path = ""
     
+    message = f"✅ Karaoke video ready! {video_status}"
+    with _full_quality_lock:
+        full_separation = _full_quality_jobs.pop(state.get("full_quality_job", ""), None)
+    if full_separation is not None:
+        # the preview video is replaced in place once the full-quality one is rendered
+        threading.Thread(target=refine_full_quality, args=(state, full_separation), daemon=True).start()
+        message += " (preview — the full-quality version replaces it when ready)"
+
     return {
         **state,
         "video_path": video_path,
         "current_step": "completed",
-        "messages": state["messages"] + [AIMessage(content=f"✅ Karaoke video ready! {video_status}")]
+        "messages": state["messages"] + [AIMessage(content=message)]
     }
 
 
@@ -1,7 +1,6 @@
 import subprocess
 import sys
 import os
-import shutil
 import requests
 import zipfile
 
@@ -33,18 +32,15 @@ def install_system_dependencies():
 
 
 def setup_vocal_remover():
-    """Download and setup vocal-remover with model checkpoint"""
+    """Download the vocal-remover model checkpoint if it is missing"""
     utils_dir = os.path.join(os.path.dirname(__file__), 'utils')
     vocal_remover_dir = os.path.join(utils_dir, 'vocal-remover')
+    model_path = os.path.join(vocal_remover_dir, 'models', 'baseline.pth')
     
-    # Create utils directory if it doesn't exist
-    os.makedirs(utils_dir, exist_ok=True)
-    
-    # Remove existing vocal-remover directory if it exists
-    if os.path.exists(vocal_remover_dir):
-        print(f"Removing existing vocal-remover directory...")
-        shutil.rmtree(vocal_remover_dir)
-        print(f"✓ Removed old vocal-remover directory")
+    # The separation code is kept in-tree; only the checkpoint comes from the release
+    if os.path.exists(model_path):
+        print(f"✓ Vocal-remover model already present at {model_path}")
+        return
     
     # Download vocal-remover zip
     print("Downloading vocal-remover with model checkpoint...")
@@ -70,12 +66,13 @@ def setup_vocal_remover():
         
         print("\n✓ Downloaded vocal-remover successfully")
         
-        # Extract zip file
-        print("Extracting vocal-remover...")
+        # Extract only the model checkpoint so the in-tree code is left untouched
+        print("Extracting vocal-remover model...")
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(utils_dir)
+            members = [name for name in zip_ref.namelist() if '/models/' in name]
+            zip_ref.extractall(utils_dir, members=members)
         
-        print("✓ Extracted vocal-remover successfully")
+        print("✓ Extracted vocal-remover model successfully")
         
         # Delete zip file
         os.remove(zip_path)
@@ -1,6 +1,11 @@
 import os
 import shutil
 import subprocess
+import threading
+
+# ffmpeg writes into the working directory and move_video picks up every .mp4
+# there, so concurrent renders (e.g. a background full-quality refresh) take turns
+_render_lock = threading.Lock()
 
 def move_video(song_name):
     curr_path = os.getcwd()
@@ -17,10 +22,12 @@ def image_to_video(song_name):
     text_file = os.path.join(curr_path, 'processed_songs', f'{song_name}', 'images_duration.txt')
     audio_file = os.path.join(curr_path, 'processed_songs', f'{song_name}',f'{song_name}_Merged.wav')
     command = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", f"{text_file}", "-i", f"{audio_file}", "-c:v", "libx264","-r", "30", "-pix_fmt", "yuv420p", f"{song_name}_karaoke.mp4"]
-    try:
-        subprocess.run(command, shell=False)
-        print("Video Generated Successfully")
-    except subprocess.CalledProcessError as e:
-        print("Error while generating the video: ", e)
-    
-    move_video(song_name)
\ No newline at end of file
+    with _render_lock:
+        try:
+            subprocess.run(command, shell=False)
+            print("Video Generated Successfully")
+        except subprocess.CalledProcessError as e:
+            print("Error while generating the video: ", e)
+        
+        # shutil.move renames over the previous video, so a preview is replaced atomically
+        move_video(song_name)
\ No newline at end of file
@@ -6,15 +6,26 @@ import librosa
 import numpy as np
 import math
 import json
+import threading
 import soundfile as sf
 
+VOCAL_REMOVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vocal-remover')
+if VOCAL_REMOVER_DIR not in sys.path:
+    sys.path.insert(0, VOCAL_REMOVER_DIR)
+
+from lib import audio
+
+_separation_service = None
+_separation_service_lock = threading.Lock()
+
 def merge_audio(song_name, volume_factor=0):
     curr_dir = os.getcwd()
     dest_dir = os.path.join(curr_dir, 'processed_songs', f'{song_name}', f'{song_name}_Merged.wav')
     
-    # Load as stereo (mono=False) to preserve channel info
-    vocals, sr_vocals = librosa.load(f'./processed_songs/{song_name}/{song_name}_Vocals.wav', mono=False)
-    instrumentals, sr_inst = librosa.load(f'./processed_songs/{song_name}/{song_name}_Instruments.wav', mono=False)
+    # Decoded as (channels, samples) at the native rate of the stems; the
+    # instrumentals are only resampled if their rate differs from the vocals
+    vocals, sr_vocals = audio.load(f'./processed_songs/{song_name}/{song_name}_Vocals.wav')
+    instrumentals, sr_inst = audio.load(f'./processed_songs/{song_name}/{song_name}_Instruments.wav', sr=sr_vocals)
     
     # If either is mono (shape is 1D), reshape to (1, samples)
     if vocals.ndim == 1:
@@ -58,16 +69,42 @@ def move_transcriptions(song_name):
             dest_file = os.path.join(lyrics_path, file)
             shutil.move(source_file, dest_file)
 
-def vocal_separation(song_name):
-    curr_path = str(os.getcwd())
-    file_path = os.path.join(curr_path,r"utils/vocal-remover")
-    v_s_cmd = ["python", os.path.join(file_path,"inference.py"), "--input", f"songs/{song_name}.mp3"]
-    try:
-        subprocess.run(v_s_cmd, shell=False)
-        print("Vocal separated successfully")
-    except subprocess.CalledProcessError as e:
-        print("error: ", e)
-    move_vocals(song_name=song_name)
+def get_separation_service():
+    # Keeps one warm Separator per process so the model is built and loaded only once
+    global _separation_service
+    with _separation_service_lock:
+        if _separation_service is None:
+            from service import SeparationService
+            _separation_service = SeparationService(
+                precision=os.getenv('SEPARATION_PRECISION', 'fp32'),
+                shards=int(os.getenv('SEPARATION_SHARDS', '1')),
+                cache_dir=os.getenv('SEPARATION_CACHE_DIR', os.path.join(os.getcwd(), 'processed_songs', '.stem_cache')),
+                cache_size=int(os.getenv('SEPARATION_CACHE_SIZE_MB', '2048')) << 20,
+                gate_db=float(os.environ['SEPARATION_GATE_DB']) if 'SEPARATION_GATE_DB' in os.environ else None
+            )
+    return _separation_service
+
+def vocal_separation(song_name, vocal_volume=None, preview_seconds=None):
+    # With vocal_volume the karaoke mix is written directly as <song>_Merged.wav
+    # next to the vocals, and no instruments stem is produced.
+    # With preview_seconds only the head of the song is separated now; the
+    # full-quality stems are separated in the background into a staging
+    # directory. The returned future yields their paths, which
+    # promote_full_quality moves over the preview stems.
+    dest_dir = os.path.join(os.getcwd(), 'processed_songs', f'{song_name}')
+    input_path = os.path.join('songs', f'{song_name}.mp3')
+    service = get_separation_service()
+    if preview_seconds:
+        service.separate(input_path, output_dir=dest_dir, mix_gain=vocal_volume, seconds=preview_seconds)
+        print("Preview vocals separated successfully")
+        return service.submit_staged(input_path, output_dir=dest_dir, mix_gain=vocal_volume)
+    service.separate(input_path, output_dir=dest_dir, mix_gain=vocal_volume)
+    print("Vocal separated successfully")
+
+def promote_full_quality(song_name, staged_paths):
+    # only called once nothing reads the preview stems any more
+    dest_dir = os.path.join(os.getcwd(), 'processed_songs', f'{song_name}')
+    return get_separation_service().promote_staged(staged_paths, dest_dir)
  
 def whisper_transcription(song_name):
     curr_path = str(os.getcwd())
@@ -83,7 +120,7 @@ def whisper_transcription(song_name):
 def get_correct_timestamp(song_name):
     songs_folder = os.path.join(os.getcwd(), 'processed_songs', f'{song_name}')
     song_file = os.path.join(songs_folder, f'{song_name}_Vocals.wav')
-    signal, sr = librosa.load(song_file)
+    signal, sr = audio.load(song_file, mono=True)
     with open(os.path.join(songs_folder,'lyrics', f'{song_name}_Vocals.json'), 'r') as f:
         json_data = json.load(f)
     chunk_seconds = math.ceil(json_data['segments'][0]['end']) # max chunk length-different for each song
@@ -0,0 +1,107 @@
+import argparse
+import os
+import sys
+import time
+
+import librosa
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import audio  # noqa: E402
+from lib import dataset  # noqa: E402
+from lib import spec_utils  # noqa: E402
+
+
+def mono_heads(a, b, sr):
+    # the signals align_wave_head_and_tail correlates
+    a, _ = librosa.effects.trim(a)
+    b, _ = librosa.effects.trim(b)
+
+    a_mono = a[:, :sr * 4].sum(axis=0)
+    b_mono = b[:, :sr * 4].sum(axis=0)
+
+    return a_mono - a_mono.mean(), b_mono - b_mono.mean()
+
+
+def synthetic_pairs(n_pair, sr, seed=0):
+    # instruments lagging the mixture by a known number of samples
+    rng = np.random.default_rng(seed)
+    for i in range(n_pair):
+        t = np.arange(10 * sr) / sr
+        y = 0.05 * rng.standard_normal((2, len(t)))
+        for f0 in rng.uniform(60, 1000, size=6):
+            y += 0.1 * np.sin(2 * np.pi * f0 * t) * (np.sin(2 * np.pi * rng.uniform(0.5, 4) * t) > 0)
+        v = 0.1 * rng.standard_normal((2, len(t))) * (np.sin(2 * np.pi * 0.7 * t) > 0)
+        delay = rng.integers(0, sr // 10)
+        X = y + v
+        y = np.concatenate([np.zeros((2, delay)), y], axis=1)
+
+        yield 'synthetic{}'.format(i), X.astype(np.float32), y.astype(np.float32)
+
+
+def file_pairs(mixtures, instruments, sr):
+    for mix_path, inst_path in dataset.make_pair(mixtures, instruments):
+        X, _ = audio.load(mix_path, sr, cache=False)
+        y, _ = audio.load(inst_path, sr, cache=False)
+        if X.ndim == 1:
+            X = np.asarray([X, X])
+        if y.ndim == 1:
+            y = np.asarray([y, y])
+
+        yield os.path.basename(mix_path), X, y
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+
+    return result, (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--mixtures', '-m', type=str, default=None)
+    p.add_argument('--instruments', '-i', type=str, default=None)
+    p.add_argument('--pairs', '-n', type=int, default=3)
+    p.add_argument('--max_lag', '-L', type=float, default=1.0)
+    p.add_argument('--repeat', type=int, default=1)
+    args = p.parse_args()
+
+    if args.mixtures is not None:
+        pairs = file_pairs(args.mixtures, args.instruments, args.sr)
+    else:
+        pairs = synthetic_pairs(args.pairs, args.sr)
+    max_lag = int(args.max_lag * args.sr)
+
+    total = {'direct': 0., 'fft': 0., 'bounded': 0.}
+    n_match = n_match_bounded = n_pair = 0
+    for name, X, y in pairs:
+        a_mono, b_mono = mono_heads(X, y, args.sr)
+
+        direct, t_direct = timeit(lambda: np.argmax(np.correlate(a_mono, b_mono, 'full')), args.repeat)
+        fft, t_fft = timeit(lambda: spec_utils.argmax_correlation(a_mono, b_mono), args.repeat)
+        bounded, t_bounded = timeit(
+            lambda: spec_utils.argmax_correlation(a_mono, b_mono, max_lag), args.repeat
+        )
+
+        offset = len(a_mono) - 1
+        print('{}: delay {} / {} / {}, direct {:.3f}s, fft {:.4f}s, bounded {:.4f}s'.format(
+            name, direct - offset, fft - offset, bounded - offset, t_direct, t_fft, t_bounded
+        ))
+
+        total['direct'] += t_direct
+        total['fft'] += t_fft
+        total['bounded'] += t_bounded
+        n_match += int(direct == fft)
+        n_match_bounded += int(direct == bounded)
+        n_pair += 1
+
+    print('{} pairs, identical delays: fft {}, bounded {}'.format(n_pair, n_match, n_match_bounded))
+    print('total direct {:.3f}s, fft {:.4f}s ({:.0f}x), bounded {:.4f}s ({:.0f}x)'.format(
+        total['direct'],
+        total['fft'], total['direct'] / total['fft'],
+        total['bounded'], total['direct'] / total['bounded']
+    ))
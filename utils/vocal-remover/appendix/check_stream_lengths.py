@@ -0,0 +1,54 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import soundfile as sf
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import inference  # noqa: E402
+from lib import nets  # noqa: E402
+
+
+# Regression check for streaming separation of short inputs and short blocks:
+# a first block shorter than the crop context used to give a negative patch
+# count, and an empty input used to fail in the STFT/ISTFT flush. The stems
+# must have the length of the input, as on the whole-file path.
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    args = p.parse_args()
+
+    torch.manual_seed(0)
+    model = nets.CascadedNet(2048, 1024, 32, 128)
+    sp = inference.Separator(model, torch.device('cpu'), batchsize=4, cropsize=256)
+    sp.progress = False
+
+    rng = np.random.default_rng(0)
+    # (input seconds, block seconds)
+    cases = [(0., 30.), (1., 30.), (5., 1.3), (5., 0.2)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for seconds, block_seconds in cases:
+            n_sample = int(seconds * args.sr)
+            input_path = os.path.join(tmp_dir, 'input.wav')
+            wave = 0.1 * rng.standard_normal((n_sample, 2)).astype(np.float32)
+            sf.write(input_path, wave, args.sr)
+
+            for normalization in ['prescan', 'running']:
+                paths = inference.separate_file_stream(
+                    sp, input_path, tmp_dir, sr=args.sr, block_seconds=block_seconds,
+                    normalization=normalization
+                )
+                for path in paths:
+                    stem, _ = sf.read(path, dtype='float32', always_2d=True)
+                    print('{}s in {}s blocks, {}: {} of {} samples'.format(
+                        seconds, block_seconds, normalization, len(stem), n_sample
+                    ))
+                    assert np.all(np.isfinite(stem)), path
+                    assert abs(len(stem) - n_sample) < 1024, path
+
+    print('ok')
@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import soundfile as sf
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import inference  # noqa: E402
+from lib import nets  # noqa: E402
+
+
+# Regression check for streaming separation with the running normalization:
+# blocks that are silent up to that point used to be divided by a zero
+# running maximum, and the NaN mask was written as full-scale samples.
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--intro', type=float, default=8.)
+    p.add_argument('--seconds', type=float, default=4.)
+    p.add_argument('--block_seconds', type=float, default=2.)
+    args = p.parse_args()
+
+    torch.manual_seed(0)
+    model = nets.CascadedNet(2048, 1024, 32, 128)
+    sp = inference.Separator(model, torch.device('cpu'), batchsize=4, cropsize=256)
+    sp.progress = False
+
+    rng = np.random.default_rng(0)
+    intro = np.zeros((int(args.intro * args.sr), 2), dtype=np.float32)
+    body = 0.1 * rng.standard_normal((int(args.seconds * args.sr), 2)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'input.wav')
+        sf.write(input_path, np.concatenate([intro, body]), args.sr)
+
+        paths = inference.separate_file_stream(
+            sp, input_path, tmp_dir, sr=args.sr, block_seconds=args.block_seconds,
+            normalization='running'
+        )
+        for path in paths:
+            wave, _ = sf.read(path, dtype='float32')
+            n_bad = int(np.sum(~np.isfinite(wave)) + np.sum(np.abs(wave[:len(intro)]) > 1e-4))
+            print('{}: {} bad samples'.format(os.path.basename(path), n_bad))
+            assert n_bad == 0, '{} has {} bad samples'.format(path, n_bad)
+
+    print('ok')
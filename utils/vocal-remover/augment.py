@@ -1,78 +1,122 @@
-import argparse
-import os
-import subprocess
-
-import librosa
-import numpy as np
-import soundfile as sf
-from tqdm import tqdm
-
-from lib import dataset
-from lib import spec_utils
-
-
-if __name__ == '__main__':
-    p = argparse.ArgumentParser()
-    p.add_argument('--sr', '-r', type=int, default=44100)
-    p.add_argument('--hop_length', '-l', type=int, default=1024)
-    p.add_argument('--n_fft', '-f', type=int, default=2048)
-    p.add_argument('--pitch', '-p', type=int, default=-1)
-    p.add_argument('--mixtures', '-m', required=True)
-    p.add_argument('--instruments', '-i', required=True)
-    args = p.parse_args()
-
-    input_i = 'input_i_{}.wav'.format(args.pitch)
-    input_v = 'input_v_{}.wav'.format(args.pitch)
-    output_i = 'output_i_{}.wav'.format(args.pitch)
-    output_v = 'output_v_{}.wav'.format(args.pitch)
-    cmd_i = 'soundstretch {} {} -pitch={}'.format(input_i, output_i, args.pitch)
-    cmd_v = 'soundstretch {} {} -pitch={}'.format(input_v, output_v, args.pitch)
-    cache_suffix = '_pitch{}.npy'.format(args.pitch)
-
-    cache_dir = 'sr{}_hl{}_nf{}'.format(args.sr, args. hop_length, args.n_fft)
-    mix_cache_dir = os.path.join(args.mixtures, cache_dir)
-    inst_cache_dir = os.path.join(args.instruments, cache_dir)
-    os.makedirs(mix_cache_dir, exist_ok=True)
-    os.makedirs(inst_cache_dir, exist_ok=True)
-
-    filelist = dataset.make_pair(args.mixtures, args.instruments)
-    for mix_path, inst_path in tqdm(filelist):
-        mix_basename = os.path.splitext(os.path.basename(mix_path))[0]
-        mix_cache_path = os.path.join(mix_cache_dir, mix_basename + cache_suffix)
-
-        inst_basename = os.path.splitext(os.path.basename(inst_path))[0]
-        inst_cache_path = os.path.join(inst_cache_dir, inst_basename + cache_suffix)
-
-        if os.path.exists(mix_cache_path) and os.path.exists(inst_cache_path):
-            continue
-
-        X, _ = librosa.load(
-            mix_path, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
-        y, _ = librosa.load(
-            inst_path, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
-
-        X, y = spec_utils.align_wave_head_and_tail(X, y, args.sr)
-        v = X - y
-
-        sf.write(input_i, y.T, args.sr)
-        sf.write(input_v, v.T, args.sr)
-        subprocess.call(cmd_i, stderr=subprocess.DEVNULL)
-        subprocess.call(cmd_v, stderr=subprocess.DEVNULL)
-
-        y, _ = librosa.load(
-            output_i, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
-        v, _ = librosa.load(
-            output_v, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
-
-        X = y + v
-
-        spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
-        np.save(mix_cache_path, spec)
-
-        spec = spec_utils.wave_to_spectrogram(y, args.hop_length, args.n_fft)
-        np.save(inst_cache_path, spec)
-
-        os.remove(input_i)
-        os.remove(input_v)
-        os.remove(output_i)
-        os.remove(output_v)
+import argparse
+import contextlib
+import multiprocessing
+import os
+from concurrent import futures
+
+import librosa
+import numpy as np
+from tqdm import tqdm
+
+from lib import audio
+from lib import dataset
+from lib import spec_utils
+
+
+# math library thread pools of every worker (numpy's BLAS, numba and torch,
+# which lib.spec_utils imports), so that N workers use N cores
+WORKER_THREADS = {
+    'OMP_NUM_THREADS': '1',
+    'OPENBLAS_NUM_THREADS': '1',
+    'MKL_NUM_THREADS': '1',
+    'NUMBA_NUM_THREADS': '1'
+}
+
+
+@contextlib.contextmanager
+def environ(variables):
+    saved = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def pitch_shift(waves, sr, n_steps):
+    # waves: (..., n_sample); every leading axis is shifted independently
+    return librosa.effects.pitch_shift(waves, sr=sr, n_steps=n_steps)
+
+
+def augment_pair(mix_path, inst_path, jobs, sr, hop_length, n_fft):
+    # The pair is decoded and aligned once and shifted to every pitch in
+    # `jobs` (pitch, mix_cache_path, inst_cache_path) without touching disk.
+    X, _ = audio.load(mix_path, sr, cache=False)
+    y, _ = audio.load(inst_path, sr, cache=False)
+
+    X, y = spec_utils.align_wave_head_and_tail(X, y, sr)
+    v = X - y
+
+    for pitch, mix_cache_path, inst_cache_path in jobs:
+        y_shift, v_shift = pitch_shift(np.asarray([y, v]), sr, pitch)
+        X_shift = y_shift + v_shift
+
+        X_spec, y_spec = spec_utils.wave_to_spectrogram(
+            np.asarray([X_shift, y_shift]), hop_length, n_fft
+        )
+        for spec, cache_path in zip([X_spec, y_spec], [mix_cache_path, inst_cache_path]):
+            # written aside and renamed, so an interrupted run leaves no truncated cache
+            with open(cache_path + '.tmp', 'wb') as f:
+                np.save(f, spec)
+            os.replace(cache_path + '.tmp', cache_path)
+
+    return mix_path
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--hop_length', '-l', type=int, default=1024)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--pitch', '-p', type=int, nargs='+', default=[-1])
+    p.add_argument('--mixtures', '-m', required=True)
+    p.add_argument('--instruments', '-i', required=True)
+    p.add_argument('--num_workers', '-w', type=int, default=os.cpu_count())
+    args = p.parse_args()
+
+    cache_dir = 'sr{}_hl{}_nf{}'.format(args.sr, args. hop_length, args.n_fft)
+    mix_cache_dir = os.path.join(args.mixtures, cache_dir)
+    inst_cache_dir = os.path.join(args.instruments, cache_dir)
+    os.makedirs(mix_cache_dir, exist_ok=True)
+    os.makedirs(inst_cache_dir, exist_ok=True)
+
+    filelist = dataset.make_pair(args.mixtures, args.instruments)
+    tasks = []
+    for mix_path, inst_path in filelist:
+        mix_basename = os.path.splitext(os.path.basename(mix_path))[0]
+        inst_basename = os.path.splitext(os.path.basename(inst_path))[0]
+
+        jobs = []
+        for pitch in args.pitch:
+            cache_suffix = '_pitch{}.npy'.format(pitch)
+            mix_cache_path = os.path.join(mix_cache_dir, mix_basename + cache_suffix)
+            inst_cache_path = os.path.join(inst_cache_dir, inst_basename + cache_suffix)
+
+            if os.path.exists(mix_cache_path) and os.path.exists(inst_cache_path):
+                continue
+            jobs.append((pitch, mix_cache_path, inst_cache_path))
+
+        if len(jobs) > 0:
+            tasks.append((mix_path, inst_path, jobs))
+
+    if args.num_workers > 1:
+        # The limits are read when numpy, numba and torch are imported, which
+        # a forked worker has already done, so the workers are spawned with
+        # them in their environment. Workers are started by submit, and the
+        # limits only apply while that happens.
+        ctx = multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(max_workers=args.num_workers, mp_context=ctx) as executor:
+            with environ(WORKER_THREADS):
+                pending = [
+                    executor.submit(augment_pair, *task, args.sr, args.hop_length, args.n_fft)
+                    for task in tasks
+                ]
+            for future in tqdm(futures.as_completed(pending), total=len(pending)):
+                future.result()
+    else:
+        for task in tqdm(tasks):
+            augment_pair(*task, args.sr, args.hop_length, args.n_fft)
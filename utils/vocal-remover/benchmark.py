@@ -0,0 +1,188 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from concurrent import futures
+
+import numpy as np
+import torch
+
+import inference
+from lib import nets
+from lib import spec_utils
+from lib import throughput
+
+
+class CountingSeparator(inference.Separator):
+
+    progress = False
+
+    def __init__(self, *args, **kwargs):
+        super(CountingSeparator, self).__init__(*args, **kwargs)
+        self.n_patch = 0
+
+    def _predict_batch(self, X_batch):
+        self.n_patch += len(X_batch)
+        return super(CountingSeparator, self)._predict_batch(X_batch)
+
+
+def synthetic_wave(seconds, sr, seed=0):
+    # a few detuned partials per channel over a noise floor
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    wave = 0.01 * rng.standard_normal((2, len(t)))
+    for f0 in rng.uniform(80, 2000, size=8):
+        for c in range(2):
+            wave[c] += 0.05 * np.sin(2 * np.pi * f0 * (1 + 0.001 * c) * t + rng.uniform(0, 2 * np.pi))
+
+    return wave.astype(np.float32)
+
+
+def run_config(config):
+    # runs in a fresh process so that thread settings and peak RSS are per config
+    torch.set_num_threads(config['threads'])
+    device = torch.device('cpu')
+
+    pretrained_model = config['pretrained_model']
+    tmp_path = None
+    if pretrained_model is None:
+        torch.manual_seed(config['seed'])
+        model = nets.CascadedNet(config['n_fft'], config['hop_length'], 32, 128, config['complex'])
+        fd, tmp_path = tempfile.mkstemp(suffix='.pth')
+        os.close(fd)
+        torch.save(model.state_dict(), tmp_path)
+        pretrained_model = tmp_path
+
+    try:
+        model = inference.load_model(
+            pretrained_model, config['n_fft'], config['hop_length'], config['complex'], device,
+            config['precision']
+        )
+    finally:
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+    sp = CountingSeparator(
+        model=model,
+        device=device,
+        batchsize=config['batchsize'],
+        cropsize=config['cropsize'],
+        precision=config['precision']
+    )
+    n_fft = model.n_fft
+    hop_length = model.hop_length
+
+    X = synthetic_wave(config['seconds'], config['sr'], config['seed'])
+
+    # one crop to warm up allocators and kernels
+    sp._predict_mask(spec_utils.wave_to_spectrogram(X[:, :config['cropsize'] * hop_length], hop_length, n_fft))
+    sp.n_patch = 0
+
+    elapsed = {'stft': 0., 'forward': 0., 'postprocess': 0., 'istft': 0.}
+    for _ in range(config['repeat']):
+        start = time.perf_counter()
+        X_spec = spec_utils.wave_to_spectrogram(X, hop_length, n_fft)
+        elapsed['stft'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if config['tta']:
+            mask = sp._predict_mask_tta(X_spec)
+        else:
+            mask = sp._predict_mask(X_spec)
+        elapsed['forward'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        y_spec, v_spec = sp._postprocess(X_spec, mask)
+        elapsed['postprocess'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        spec_utils.spectrogram_to_wave(np.asarray([y_spec, v_spec]), hop_length=hop_length)
+        elapsed['istft'] += time.perf_counter() - start
+
+    elapsed = {k: v / config['repeat'] for k, v in elapsed.items()}
+    elapsed['total'] = sum(elapsed.values())
+    n_patch = sp.n_patch / config['repeat']
+
+    return dict(
+        config,
+        time=elapsed,
+        rtf=elapsed['total'] / config['seconds'],
+        patches=n_patch,
+        patches_per_second=n_patch / elapsed['forward'],
+        # None where the resource module is not available (Windows)
+        peak_rss_mb=throughput.peak_rss_mb()
+    )
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--pretrained_model', '-P', type=str, default=None)
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--complex', '-X', action='store_true')
+    p.add_argument('--seconds', '-s', type=float, nargs='+', default=[10, 60])
+    p.add_argument('--batchsize', '-B', type=int, nargs='+', default=[1, 4])
+    p.add_argument('--cropsize', '-c', type=int, nargs='+', default=[256])
+    p.add_argument('--tta', '-t', type=int, nargs='+', choices=[0, 1], default=[0])
+    p.add_argument('--threads', '-T', type=int, nargs='+', default=[torch.get_num_threads()])
+    p.add_argument('--precision', '-p', type=str, nargs='+', choices=['fp32', 'int8', 'bf16'], default=['fp32'])
+    p.add_argument('--repeat', '-n', type=int, default=1)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--output', '-o', type=str, default='benchmark.json')
+    args = p.parse_args()
+
+    sweep = itertools.product(
+        args.seconds, args.batchsize, args.cropsize, args.tta, args.threads, args.precision
+    )
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for seconds, batchsize, cropsize, tta, threads, precision in sweep:
+        config = {
+            'pretrained_model': args.pretrained_model,
+            'sr': args.sr,
+            'n_fft': args.n_fft,
+            'hop_length': args.hop_length,
+            'complex': args.complex,
+            'seconds': seconds,
+            'batchsize': batchsize,
+            'cropsize': cropsize,
+            'tta': bool(tta),
+            'threads': threads,
+            'precision': precision,
+            'repeat': args.repeat,
+            'seed': args.seed
+        }
+        print('seconds={} batchsize={} cropsize={} tta={} threads={} precision={}...'.format(
+            seconds, batchsize, cropsize, bool(tta), threads, precision
+        ), end=' ', flush=True)
+        with futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            result = executor.submit(run_config, config).result()
+        text = 'rtf {:.3f}, {:.1f} patches/s'.format(result['rtf'], result['patches_per_second'])
+        if result['peak_rss_mb'] is not None:
+            text += ', {:.0f} MB'.format(result['peak_rss_mb'])
+        print(text)
+        results.append(result)
+
+    report = {
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,109 +1,208 @@
-import argparse
-import os
-# import re
-
-import librosa
-import numpy as np
-import soundfile as sf
-import torch
-
-from lib import dataset
-from lib import nets
-from lib import spec_utils
-
-import inference
-
-
-MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
-DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
-
-
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('--gpu', '-g', type=int, default=-1)
-    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
-    p.add_argument('--dataset', '-d', required=True)
-    p.add_argument('--split_mode', '-S', type=str, choices=['random', 'subdirs'], default='random')
-    p.add_argument('--sr', '-r', type=int, default=44100)
-    p.add_argument('--n_fft', '-f', type=int, default=2048)
-    p.add_argument('--hop_length', '-H', type=int, default=1024)
-    p.add_argument('--batchsize', '-B', type=int, default=4)
-    p.add_argument('--cropsize', '-c', type=int, default=256)
-    p.add_argument('--complex', '-X', action='store_true')
-    args = p.parse_args()
-
-    print('loading model...', end=' ')
-    device = torch.device('cpu')
-    model = nets.CascadedNet(args.n_fft, args.hop_length, is_complex=args.complex)
-    model.load_state_dict(torch.load(args.pretrained_model, map_location=device))
-    if torch.cuda.is_available() and args.gpu >= 0:
-        device = torch.device('cuda:{}'.format(args.gpu))
-        model.to(device)
-    print('done')
-
-    cache_dir = 'sr{}_hl{}_nf{}'.format(args.sr, args.hop_length, args.n_fft)
-    filelist = dataset.raw_data_split(
-        dataset_dir=args.dataset,
-        split_mode=args.split_mode
-    )
-
-    sp = inference.Separator(model, device, args.batchsize, args.cropsize)
-
-    for mix_path, inst_path in filelist:
-        X_basename = os.path.splitext(os.path.basename(mix_path))[0]
-        y_basename = os.path.splitext(os.path.basename(inst_path))[0]
-        pv_basename = X_basename + '_PseudoVocals'
-        # pi_basename = X_basename + '_PseudoInstruments'
-
-        print('converting {}...'.format(X_basename))
-
-        X_dir = os.path.dirname(mix_path)
-        y_dir = os.path.dirname(inst_path)
-        pv_dir = os.path.join(os.path.split(y_dir)[0], 'pseudo_vocals')
-        pi_dir = os.path.join(os.path.split(y_dir)[0], 'pseudo_instruments')
-
-        X_cache_dir = os.path.join(X_dir, cache_dir)
-        y_cache_dir = os.path.join(y_dir, cache_dir)
-        pv_cache_dir = os.path.join(pv_dir, cache_dir)
-        pi_cache_dir = os.path.join(pi_dir, cache_dir)
-
-        os.makedirs(X_cache_dir, exist_ok=True)
-        os.makedirs(y_cache_dir, exist_ok=True)
-        os.makedirs(pv_cache_dir, exist_ok=True)
-        os.makedirs(pi_cache_dir, exist_ok=True)
-
-        X, sr = librosa.load(
-            mix_path, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
-        y, sr = librosa.load(
-            inst_path, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
-
-        if X.ndim == 1:
-            # mono to stereo
-            X = np.asarray([X, X])
-
-        X, y = spec_utils.align_wave_head_and_tail(X, y, sr)
-        X = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
-        y = spec_utils.wave_to_spectrogram(y, args.hop_length, args.n_fft)
-
-        # if re.match(r'\d{3}_mixture', X_basename) and re.match(r'\d{3}_inst', y_basename):
-        #     print('this is DSD100 Dataset')
-        #     pv = X - y
-        #     pi = y
-        # else:
-        _, pv = sp.separate_tta(X - y)
-        # pa, pv = sp.separate_tta(X - y)
-        # pi = y + pa
-
-        wave = spec_utils.spectrogram_to_wave(pv, hop_length=args.hop_length)
-        sf.write('{}/{}.wav'.format(pv_dir, pv_basename), wave.T, sr)
-        # wave = spec_utils.spectrogram_to_wave(pi, hop_length=args.hop_length)
-        # sf.write('{}/{}.wav'.format(pi_dir, pi_basename), wave.T, sr)
-
-        np.save('{}/{}.npy'.format(X_cache_dir, X_basename), X.transpose(2, 0, 1))
-        np.save('{}/{}.npy'.format(y_cache_dir, y_basename), y.transpose(2, 0, 1))
-        np.save('{}/{}.npy'.format(pv_cache_dir, pv_basename), pv.transpose(2, 0, 1))
-        # np.save('{}/{}.npy'.format(pi_cache_dir, pi_basename), pi.transpose(2, 0, 1))
-
-
-if __name__ == '__main__':
-    main()
+import argparse
+from concurrent import futures
+import os
+# import re
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from lib import audio
+from lib import dataset
+from lib import nets
+from lib import spec_utils
+
+import inference
+
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
+
+
+def atomic_write(path, write):
+    # written aside and renamed, so an interrupted run leaves no truncated output
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_npy(path, spec):
+    with open(path, 'wb') as f:
+        np.save(f, spec)
+
+
+def convert_pair(sp, mix_path, inst_path, pv_path, cache_paths, sr, hop_length, n_fft):
+    X, sr = audio.load(mix_path, sr, cache=False)
+    y, sr = audio.load(inst_path, sr, cache=False)
+
+    if X.ndim == 1:
+        # mono to stereo
+        X = np.asarray([X, X])
+
+    X, y = spec_utils.align_wave_head_and_tail(X, y, sr)
+    X, y = spec_utils.wave_to_spectrogram(np.asarray([X, y]), hop_length, n_fft)
+
+    # if re.match(r'\d{3}_mixture', X_basename) and re.match(r'\d{3}_inst', y_basename):
+    #     print('this is DSD100 Dataset')
+    #     pv = X - y
+    #     pi = y
+    # else:
+    _, pv = sp.separate_tta(X - y)
+    # pa, pv = sp.separate_tta(X - y)
+    # pi = y + pa
+
+    wave = spec_utils.spectrogram_to_wave(pv, hop_length=hop_length)
+    atomic_write(pv_path, lambda path: sf.write(path, wave.T, sr, format='WAV'))
+    # wave = spec_utils.spectrogram_to_wave(pi, hop_length=hop_length)
+    # sf.write('{}/{}.wav'.format(pi_dir, pi_basename), wave.T, sr)
+
+    for spec, cache_path in zip([X, y, pv], cache_paths):
+        atomic_write(cache_path, lambda path: save_npy(path, spec.transpose(2, 0, 1)))
+    # np.save('{}/{}.npy'.format(pi_cache_dir, pi_basename), pi.transpose(2, 0, 1))
+
+    return [dataset.describe_cache(cache_path) for cache_path in cache_paths]
+
+
+_worker_separator = None
+
+
+def _init_worker(model, batchsize, cropsize, worker_ids, cores_per_worker):
+    global _worker_separator
+
+    inference.pin_worker(worker_ids, cores_per_worker)
+    _worker_separator = inference.Separator(model, torch.device('cpu'), batchsize, cropsize)
+    _worker_separator.progress = False
+
+
+def _convert_pair_in_worker(*args):
+    return convert_pair(_worker_separator, *args)
+
+
+def is_converted(pv_path, cache_paths, manifests):
+    # Valid outputs are the pseudo vocals and three caches whose manifest
+    # entries match the files. Caches from before the manifest are checked
+    # by mapping them once and then recorded.
+    if not os.path.exists(pv_path):
+        return False
+
+    for cache_path in cache_paths:
+        cache_dir, name = os.path.split(cache_path)
+        if cache_dir not in manifests:
+            manifests[cache_dir] = dataset.load_manifest(cache_dir)
+
+        if dataset.is_valid_entry(manifests[cache_dir].get(name), cache_path):
+            continue
+        if not os.path.exists(cache_path):
+            return False
+        try:
+            manifests[cache_dir][name] = dataset.describe_cache(cache_path)
+        except ValueError:
+            # truncated by an interrupted run
+            return False
+
+    return True
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--gpu', '-g', type=int, default=-1)
+    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
+    p.add_argument('--dataset', '-d', required=True)
+    p.add_argument('--split_mode', '-S', type=str, choices=['random', 'subdirs'], default='random')
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--batchsize', '-B', type=int, default=4)
+    p.add_argument('--cropsize', '-c', type=int, default=256)
+    p.add_argument('--complex', '-X', action='store_true')
+    p.add_argument('--num_workers', '-w', type=int, default=0)
+    p.add_argument('--overwrite', action='store_true')
+    args = p.parse_args()
+
+    print('loading model...', end=' ')
+    device = torch.device('cpu')
+    model = nets.CascadedNet(args.n_fft, args.hop_length, is_complex=args.complex)
+    model.load_state_dict(torch.load(args.pretrained_model, map_location=device))
+    if torch.cuda.is_available() and args.gpu >= 0:
+        device = torch.device('cuda:{}'.format(args.gpu))
+        model.to(device)
+    print('done')
+
+    filelist = dataset.raw_data_split(
+        dataset_dir=args.dataset,
+        split_mode=args.split_mode
+    )
+
+    manifests = {}
+    jobs = []
+    for mix_path, inst_path in filelist:
+        X_basename = os.path.splitext(os.path.basename(mix_path))[0]
+        pv_basename = X_basename + '_PseudoVocals'
+        # pi_basename = X_basename + '_PseudoInstruments'
+
+        y_dir = os.path.dirname(inst_path)
+        pv_dir = os.path.join(os.path.split(y_dir)[0], 'pseudo_vocals')
+        # pi_dir = os.path.join(os.path.split(y_dir)[0], 'pseudo_instruments')
+        pv_path = os.path.join(pv_dir, pv_basename + '.wav')
+
+        cache_paths = spec_utils.get_cache_paths(
+            mix_path, inst_path, pv_path, args.sr, args.hop_length, args.n_fft
+        )
+        if not args.overwrite and is_converted(pv_path, cache_paths, manifests):
+            print('{} already converted'.format(X_basename))
+            continue
+
+        os.makedirs(pv_dir, exist_ok=True)
+        for cache_path in cache_paths:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        jobs.append((mix_path, inst_path, pv_path, cache_paths))
+
+    def record(job, entries):
+        mix_path, _, _, cache_paths = job
+        print('converted {}'.format(os.path.splitext(os.path.basename(mix_path))[0]))
+
+        # manifests are only written here, so training starts without rescanning
+        for cache_path, entry in zip(cache_paths, entries):
+            cache_dir, name = os.path.split(cache_path)
+            if cache_dir not in manifests:
+                manifests[cache_dir] = dataset.load_manifest(cache_dir)
+            manifests[cache_dir][name] = entry
+            dataset.save_manifest(cache_dir, manifests[cache_dir])
+
+    if args.num_workers > 0:
+        if device.type != 'cpu':
+            raise ValueError('parallel conversion is only available on CPU')
+        if hasattr(os, 'sched_getaffinity'):
+            n_cores = len(os.sched_getaffinity(0))
+        else:
+            n_cores = os.cpu_count()
+
+        # one separator per worker on its own slice of the cores, all of them
+        # mapping the same shared copy of the weights
+        model.share_memory()
+        ctx = torch.multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(
+                max_workers=args.num_workers,
+                mp_context=ctx,
+                initializer=_init_worker,
+                initargs=(
+                    model, args.batchsize, args.cropsize,
+                    ctx.Value('i', 0), max(n_cores // args.num_workers, 1)
+                )) as executor:
+            pending = {
+                executor.submit(_convert_pair_in_worker, *job, args.sr, args.hop_length, args.n_fft): job
+                for job in jobs
+            }
+            for future in futures.as_completed(pending):
+                record(pending[future], future.result())
+    else:
+        sp = inference.Separator(model, device, args.batchsize, args.cropsize)
+        for job in jobs:
+            record(job, convert_pair(sp, *job, args.sr, args.hop_length, args.n_fft))
+
+    for cache_dir, manifest in manifests.items():
+        dataset.save_manifest(cache_dir, manifest)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,107 +1,286 @@
-import argparse
-import os
-
-import librosa
-import museval
-import numpy as np
-import torch
-
-from lib import nets
-from lib import spec_utils
-
-import inference
-
-
-MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
-DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
-
-
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('--gpu', '-g', type=int, default=-1)
-    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
-    p.add_argument('--input', '-i', required=True)
-    p.add_argument('--sr', '-r', type=int, default=44100)
-    p.add_argument('--n_fft', '-f', type=int, default=2048)
-    p.add_argument('--hop_length', '-H', type=int, default=1024)
-    p.add_argument('--batchsize', '-B', type=int, default=4)
-    p.add_argument('--cropsize', '-c', type=int, default=256)
-    p.add_argument('--output_image', '-I', action='store_true')
-    p.add_argument('--tta', '-t', action='store_true')
-    p.add_argument('--output_dir', '-o', type=str, default="")
-    p.add_argument('--complex', '-X', action='store_true')
-    args = p.parse_args()
-
-    print('loading model...', end=' ')
-    device = torch.device('cpu')
-    if args.gpu >= 0:
-        if torch.cuda.is_available():
-            device = torch.device('cuda:{}'.format(args.gpu))
-        elif torch.backends.mps.is_available() and torch.backends.mps.is_built():
-            device = torch.device('mps')
-    model = nets.CascadedNet(args.n_fft, args.hop_length, 32, 128, args.complex)
-    model.load_state_dict(torch.load(args.pretrained_model, map_location='cpu'))
-    model.to(device)
-    print('done')
-
-    sp = inference.Separator(
-        model=model,
-        device=device,
-        batchsize=args.batchsize,
-        cropsize=args.cropsize
-    )
-
-    all = []
-    dirs = os.listdir(args.input)
-    for dir in dirs:
-        print(dir, end=' ')
-        dir = os.path.join(args.input, dir)
-        bass, _ = librosa.load(
-            os.path.join(dir, 'bass.wav'), sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_best'
-        )
-        drums, _ = librosa.load(
-            os.path.join(dir, 'drums.wav'), sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_best'
-        )
-        other, _ = librosa.load(
-            os.path.join(dir, 'other.wav'), sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_best'
-        )
-        vocals, _ = librosa.load(
-            os.path.join(dir, 'vocals.wav'), sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_best'
-        )
-        y = bass + drums + other
-        X = y + vocals
-        print('done')
-
-        print('stft of wave source...', end=' ')
-        X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
-        print('done')
-
-        if args.tta:
-            y_spec, v_spec = sp.separate_tta(X_spec)
-        else:
-            y_spec, v_spec = sp.separate(X_spec)
-
-        y_wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=args.hop_length)
-        v_wave = spec_utils.spectrogram_to_wave(v_spec, hop_length=args.hop_length)
-
-        SDR, ISR, SIR, SAR = museval.evaluate(
-            [y.T, vocals.T], [y_wave.T, v_wave.T]
-        )
-
-        sdr = np.nanmean(SDR, axis=1)
-        isr = np.nanmean(ISR, axis=1)
-        sir = np.nanmean(SIR, axis=1)
-        sar = np.nanmean(SAR, axis=1)
-
-        print(sdr)
-        print(isr)
-        print(sir)
-        print(sar)
-
-        all.append([sdr, isr, sir, sar])
-
-    print(np.asarray(all).mean(axis=0))
-
-
-if __name__ == '__main__':
-    main()
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent import futures
+
+import museval
+import numpy as np
+
+from lib import audio
+from lib import spec_utils
+from lib import stem_cache
+
+import inference
+
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
+
+METRICS = ['sdr', 'isr', 'sir', 'sar']
+TARGETS = ['instruments', 'vocals']
+
+
+def load_track(track_dir, sr):
+    bass, _ = audio.load(os.path.join(track_dir, 'bass.wav'), sr, cache=False)
+    drums, _ = audio.load(os.path.join(track_dir, 'drums.wav'), sr, cache=False)
+    other, _ = audio.load(os.path.join(track_dir, 'other.wav'), sr, cache=False)
+    vocals, _ = audio.load(os.path.join(track_dir, 'vocals.wav'), sr, cache=False)
+    y = bass + drums + other
+
+    return y, vocals
+
+
+def separate(sp, X_spec, hop_length, tta=False):
+    if tta:
+        y_spec, v_spec = sp.separate_tta(X_spec)
+    else:
+        y_spec, v_spec = sp.separate(X_spec)
+
+    y_wave, v_wave = spec_utils.spectrogram_to_wave(
+        np.asarray([y_spec, v_spec]), hop_length=hop_length
+    )
+
+    return y_wave, v_wave
+
+
+def score(y, vocals, y_wave, v_wave):
+    SDR, ISR, SIR, SAR = museval.evaluate(
+        [y.T, vocals.T], [y_wave.T, v_wave.T]
+    )
+
+    sdr = np.nanmean(SDR, axis=1)
+    isr = np.nanmean(ISR, axis=1)
+    sir = np.nanmean(SIR, axis=1)
+    sar = np.nanmean(SAR, axis=1)
+
+    return [sdr, isr, sir, sar]
+
+
+def evaluate(sp, X_spec, y, vocals, hop_length, tta=False):
+    y_wave, v_wave = separate(sp, X_spec, hop_length, tta)
+
+    return score(y, vocals, y_wave, v_wave)
+
+
+def save_atomic(path, save):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_npy(path, array):
+    # np.save appends .npy to a path without it
+    with open(path, 'wb') as f:
+        np.save(f, array)
+
+
+def score_track(track_dir, estimate_path, result_path, sr, timing):
+    # runs in a pool process; the references are decoded here rather than
+    # sent over from the separating process
+    y, vocals = load_track(track_dir, sr)
+    y_wave, v_wave = np.load(estimate_path)
+
+    start = time.perf_counter()
+    metrics = score(y, vocals, y_wave, v_wave)
+    timing = dict(timing, evaluate=time.perf_counter() - start)
+
+    result = {
+        'track': os.path.basename(track_dir),
+        'time': timing
+    }
+    for name, metric in zip(METRICS, metrics):
+        result[name] = dict(zip(TARGETS, metric.tolist()))
+
+    # the result file marks the track as done for a resumed run
+    def save(path):
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(result, f, indent=2)
+
+    save_atomic(result_path, save)
+
+    return result
+
+
+def aggregate(results):
+    summary = {}
+    for stat, func in [('mean', np.nanmean), ('median', np.nanmedian)]:
+        summary[stat] = {
+            name: {
+                target: float(func([r[name][target] for r in results]))
+                for target in TARGETS
+            }
+            for name in METRICS
+        }
+    summary['time'] = {
+        key: float(np.sum([r['time'][key] or 0 for r in results]))
+        for key in ['load', 'separate', 'evaluate']
+    }
+
+    return summary
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--gpu', '-g', type=int, default=-1)
+    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
+    p.add_argument('--input', '-i', required=True)
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--batchsize', '-B', type=int, default=4)
+    p.add_argument('--cropsize', '-c', type=int, default=256)
+    p.add_argument('--output_image', '-I', action='store_true')
+    p.add_argument('--tta', '-t', action='store_true')
+    p.add_argument('--output_dir', '-o', type=str, default="")
+    p.add_argument('--complex', '-X', action='store_true')
+    p.add_argument('--precision', '-p', type=str, choices=['fp32', 'int8', 'bf16'], default='fp32')
+    p.add_argument('--reference_precision', type=str, choices=['fp32', 'int8', 'bf16'], default=None)
+    p.add_argument('--num_workers', '-w', type=int, default=os.cpu_count())
+    p.add_argument('--cache_dir', type=str, default='eval_cache')
+    p.add_argument('--output_json', type=str, default='eval.json')
+    args = p.parse_args()
+
+    print('loading model...', end=' ')
+    device = inference.get_device(args.gpu)
+    model = inference.load_model(
+        args.pretrained_model, args.n_fft, args.hop_length, args.complex, device, args.precision
+    )
+    print('done')
+
+    sp = inference.Separator(
+        model=model,
+        device=device,
+        batchsize=args.batchsize,
+        cropsize=args.cropsize,
+        precision=args.precision
+    )
+    runs = [('model', sp, args.precision)]
+
+    # with a reference precision, the delta of every metric against it is reported as well
+    if args.reference_precision is not None:
+        model_ref = inference.load_model(
+            args.pretrained_model, args.n_fft, args.hop_length, args.complex, device,
+            args.reference_precision
+        )
+        sp_ref = inference.Separator(
+            model_ref, device, args.batchsize, args.cropsize, args.reference_precision
+        )
+        runs.append(('reference', sp_ref, args.reference_precision))
+
+    # Separations and per-track results are kept under a directory keyed by
+    # everything that changes the output, so an interrupted run resumes where
+    # it stopped and a new checkpoint or setting gets a directory of its own.
+    # The batch size is part of it since int8 activation scales are computed
+    # per batch.
+    weights = stem_cache.hash_file(args.pretrained_model)
+    run_dirs = {}
+    for name, _, precision in runs:
+        key = stem_cache.make_key(
+            [], weights=weights, sr=args.sr, n_fft=model.n_fft, hop_length=model.hop_length,
+            batchsize=args.batchsize, cropsize=args.cropsize, tta=args.tta, is_complex=model.is_complex,
+            precision=precision
+        )
+        run_dirs[name] = os.path.join(args.cache_dir, key)
+        os.makedirs(run_dirs[name], exist_ok=True)
+
+    tracks = sorted(
+        track for track in os.listdir(args.input)
+        if os.path.isdir(os.path.join(args.input, track))
+    )
+
+    results = {name: {} for name, _, _ in runs}
+    ctx = multiprocessing.get_context('spawn')
+    with futures.ProcessPoolExecutor(max_workers=args.num_workers, mp_context=ctx) as executor:
+        pending = {}
+        for track in tracks:
+            track_dir = os.path.join(args.input, track)
+            X_spec = None
+            for name, sp, _ in runs:
+                result_path = os.path.join(run_dirs[name], track + '.json')
+                if os.path.exists(result_path):
+                    with open(result_path, 'r', encoding='utf8') as f:
+                        results[name][track] = json.load(f)
+                    print('{} ({}) found in cache'.format(track, name))
+                    continue
+
+                estimate_path = os.path.join(run_dirs[name], track + '.npy')
+                timing = {'load': None, 'separate': None}
+                if not os.path.exists(estimate_path):
+                    if X_spec is None:
+                        print('{} loading...'.format(track), end=' ')
+                        start = time.perf_counter()
+                        y, vocals = load_track(track_dir, args.sr)
+                        X_spec = spec_utils.wave_to_spectrogram(y + vocals, args.hop_length, args.n_fft)
+                        timing['load'] = time.perf_counter() - start
+                        print('done')
+
+                    start = time.perf_counter()
+                    estimate = np.asarray(separate(sp, X_spec, args.hop_length, args.tta))
+                    timing['separate'] = time.perf_counter() - start
+                    save_atomic(estimate_path, lambda path: save_npy(path, estimate))
+
+                future = executor.submit(
+                    score_track, track_dir, estimate_path, result_path, args.sr, timing
+                )
+                pending[future] = name
+
+        # museval runs in the pool while the following tracks are separated
+        for future in futures.as_completed(pending):
+            name = pending[future]
+            result = future.result()
+            results[name][result['track']] = result
+            print('{} ({}) sdr {}'.format(
+                result['track'], name,
+                ', '.join('{} {:.3f}'.format(t, result['sdr'][t]) for t in TARGETS)
+            ))
+
+    report = {
+        'config': {
+            'pretrained_model': args.pretrained_model,
+            'weights': weights,
+            'sr': args.sr,
+            'n_fft': model.n_fft,
+            'hop_length': model.hop_length,
+            'batchsize': args.batchsize,
+            'cropsize': args.cropsize,
+            'tta': args.tta,
+            'is_complex': model.is_complex
+        },
+        'runs': {}
+    }
+    for name, _, precision in runs:
+        track_results = [results[name][track] for track in tracks]
+        summary = aggregate(track_results)
+        report['runs'][name] = dict(
+            precision=precision, cache_dir=run_dirs[name], tracks=track_results, **summary
+        )
+
+        print('{} ({}) mean:'.format(name, precision))
+        for metric in METRICS:
+            print('  {} {}'.format(metric, summary['mean'][metric]))
+
+    if args.reference_precision is not None:
+        report['delta'] = {
+            stat: {
+                metric: {
+                    target: report['runs']['model'][stat][metric][target]
+                    - report['runs']['reference'][stat][metric][target]
+                    for target in TARGETS
+                }
+                for metric in METRICS
+            }
+            for stat in ['mean', 'median']
+        }
+        print('mean delta against {}:'.format(args.reference_precision))
+        for metric in METRICS:
+            print('  {} {}'.format(metric, report['delta']['mean'][metric]))
+
+    with open(args.output_json, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    print(args.output_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import os
+
+import torch
+
+from lib import nets
+
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
+    p.add_argument('--output', '-o', type=str, default=None)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--cropsize', '-c', type=int, default=256)
+    p.add_argument('--complex', '-X', action='store_true')
+    args = p.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.pretrained_model)[0] + '.jit'
+
+    print('loading model...', end=' ')
+    model = nets.CascadedNet(args.n_fft, args.hop_length, 32, 128, args.complex)
+    model.load_state_dict(torch.load(args.pretrained_model, map_location='cpu'))
+    print('done')
+
+    print('exporting model...', end=' ')
+    nets.export_model(model, output, args.cropsize)
+    print('done')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
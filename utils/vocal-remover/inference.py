@@ -1,191 +1,742 @@
-import argparse
-import os
-
-import librosa
-import numpy as np
-import soundfile as sf
-import torch
-from tqdm import tqdm
-
-from lib import dataset
-from lib import nets
-from lib import spec_utils
-from lib import utils
-
-
-class Separator(object):
-
-    def __init__(self, model, device=None, batchsize=1, cropsize=256):
-        self.model = model
-        self.offset = model.offset
-        self.device = device
-        self.batchsize = batchsize
-        self.cropsize = cropsize
-        self.is_complex = model.is_complex
-
-    def _postprocess(self, X_spec, mask):
-        if self.is_complex:
-            y_spec = X_spec * mask[:2]
-            v_spec = X_spec * mask[2:]
-        else:
-            X_mag = np.abs(X_spec)
-            X_phase = np.exp(1.j * np.angle(X_spec))
-
-            y_spec = X_mag * mask[:2] * X_phase
-            v_spec = X_mag * mask[2:] * X_phase
-
-        return y_spec, v_spec
-
-    def _separate(self, X_spec_pad, roi_size):
-        X_dataset = []
-        patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
-        for i in range(patches):
-            start = i * roi_size
-            X_spec_crop = X_spec_pad[:, :, start:start + self.cropsize]
-            X_dataset.append(X_spec_crop)
-
-        X_dataset = np.asarray(X_dataset)
-
-        self.model.eval()
-        with torch.no_grad():
-            mask_list = []
-            # To reduce the overhead, dataloader is not used.
-            for i in tqdm(range(0, patches, self.batchsize)):
-                X_batch = X_dataset[i: i + self.batchsize]
-                X_batch = torch.from_numpy(X_batch).to(self.device)
-
-                if not self.is_complex:
-                    X_batch = torch.abs(X_batch)
-
-                mask = self.model.predict_mask(X_batch)
-
-                mask = mask.detach().cpu().numpy()
-                mask = np.concatenate(mask, axis=2)
-                mask_list.append(mask)
-
-            mask = np.concatenate(mask_list, axis=2)
-
-        return mask
-
-    def separate(self, X_spec):
-        n_frame = X_spec.shape[2]
-        pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
-        X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
-        X_spec_pad /= np.abs(X_spec).max()
-
-        mask = self._separate(X_spec_pad, roi_size)
-        mask = mask[:, :, :n_frame]
-
-        y_spec, v_spec = self._postprocess(X_spec, mask)
-
-        return y_spec, v_spec
-
-    def separate_tta(self, X_spec):
-        n_frame = X_spec.shape[2]
-        pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
-        X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
-        X_spec_pad /= X_spec_pad.max()
-
-        mask = self._separate(X_spec_pad, roi_size)
-
-        pad_l += roi_size // 2
-        pad_r += roi_size // 2
-        X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
-        X_spec_pad /= X_spec_pad.max()
-
-        mask_tta = self._separate(X_spec_pad, roi_size)
-        mask_tta = mask_tta[:, :, roi_size // 2:]
-
-        mask = (mask[:, :, :n_frame] + mask_tta[:, :, :n_frame]) * 0.5
-
-        y_spec, v_spec = self._postprocess(X_spec, mask)
-
-        return y_spec, v_spec
-
-
-MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
-DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
-
-
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('--gpu', '-g', type=int, default=-1)
-    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
-    p.add_argument('--input', '-i', required=True)
-    p.add_argument('--sr', '-r', type=int, default=44100)
-    p.add_argument('--n_fft', '-f', type=int, default=2048)
-    p.add_argument('--hop_length', '-H', type=int, default=1024)
-    p.add_argument('--batchsize', '-B', type=int, default=4)
-    p.add_argument('--cropsize', '-c', type=int, default=256)
-    p.add_argument('--output_image', '-I', action='store_true')
-    p.add_argument('--tta', '-t', action='store_true')
-    p.add_argument('--output_dir', '-o', type=str, default="")
-    p.add_argument('--complex', '-X', action='store_true')
-    args = p.parse_args()
-
-    print('loading model...', end=' ')
-    device = torch.device('cpu')
-    if args.gpu >= 0:
-        if torch.cuda.is_available():
-            device = torch.device('cuda:{}'.format(args.gpu))
-        elif torch.backends.mps.is_available() and torch.backends.mps.is_built():
-            device = torch.device('mps')
-    model = nets.CascadedNet(args.n_fft, args.hop_length, 32, 128, args.complex)
-    model.load_state_dict(torch.load(args.pretrained_model, map_location='cpu'))
-    model.to(device)
-    print('done')
-
-    print('loading wave source...', end=' ')
-    X, sr = librosa.load(
-        args.input, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast'
-    )
-    basename = os.path.splitext(os.path.basename(args.input))[0]
-    print('done')
-
-    if X.ndim == 1:
-        # mono to stereo
-        X = np.asarray([X, X])
-
-    print('stft of wave source...', end=' ')
-    X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
-    print('done')
-
-    sp = Separator(
-        model=model,
-        device=device,
-        batchsize=args.batchsize,
-        cropsize=args.cropsize
-    )
-
-    if args.tta:
-        y_spec, v_spec = sp.separate_tta(X_spec)
-    else:
-        y_spec, v_spec = sp.separate(X_spec)
-
-    print('validating output directory...', end=' ')
-    output_dir = args.output_dir
-    if output_dir != "":  # modifies output_dir if theres an arg specified
-        output_dir = output_dir.rstrip('/') + '/'
-        os.makedirs(output_dir, exist_ok=True)
-    print('done')
-
-    print('inverse stft of instruments...', end=' ')
-    wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=args.hop_length)
-    print('done')
-    sf.write('{}{}_Instruments.wav'.format(output_dir, basename), wave.T, sr)
-
-    print('inverse stft of vocals...', end=' ')
-    wave = spec_utils.spectrogram_to_wave(v_spec, hop_length=args.hop_length)
-    print('done')
-    sf.write('{}{}_Vocals.wav'.format(output_dir, basename), wave.T, sr)
-
-    if args.output_image:
-        image = spec_utils.spectrogram_to_image(y_spec)
-        utils.imwrite('{}{}_Instruments.jpg'.format(output_dir, basename), image)
-
-        image = spec_utils.spectrogram_to_image(v_spec)
-        utils.imwrite('{}{}_Vocals.jpg'.format(output_dir, basename), image)
-
-
-if __name__ == '__main__':
-    main()
+import argparse
+import contextlib
+import os
+from concurrent import futures
+
+import numpy as np
+import soundfile as sf
+import torch
+from tqdm import tqdm
+
+from lib import audio
+from lib import dataset
+from lib import nets
+from lib import spec_utils
+from lib import streaming
+from lib import utils
+
+
+class Separator(object):
+
+    progress = True
+    gate_fade = 16
+    gate_smooth = True
+
+    def __init__(self, model, device=None, batchsize=1, cropsize=256, precision='fp32', gate_db=None):
+        self.model = model
+        self.offset = model.offset
+        self.device = device
+        self.batchsize = batchsize
+        self.cropsize = cropsize
+        self.is_complex = model.is_complex
+        self.autocast = precision == 'bf16'
+        self.gate_db = gate_db
+        self.skipped = 0
+
+        if self.autocast and isinstance(model, nets.ExportedNet):
+            raise ValueError('bf16 precision is not available with exported models')
+
+    def _postprocess(self, X_spec, mask):
+        if self.is_complex:
+            y_spec = X_spec * mask[:2]
+            v_spec = X_spec * mask[2:]
+        else:
+            X_mag = np.abs(X_spec)
+            X_phase = np.exp(1.j * np.angle(X_spec))
+
+            y_spec = X_mag * mask[:2] * X_phase
+            v_spec = X_mag * mask[2:] * X_phase
+
+        return y_spec, v_spec
+
+    def _iter_batches(self, X_spec_pad, starts):
+        # Crops are strided views into the padded spectrogram; only the current
+        # batch is copied into a contiguous buffer for the forward pass.
+        crops = np.lib.stride_tricks.sliding_window_view(X_spec_pad, self.cropsize, axis=2)
+        for i in range(0, len(starts), self.batchsize):
+            X_batch = crops[:, :, starts[i:i + self.batchsize]].transpose(2, 0, 1, 3)
+            yield i, np.ascontiguousarray(X_batch)
+
+    def _predict_batch(self, X_batch):
+        X_batch = torch.from_numpy(X_batch).to(self.device)
+
+        if not self.is_complex:
+            X_batch = torch.abs(X_batch)
+
+        # the network body runs in bfloat16, its mask head stays in fp32
+        device_type = 'cuda' if X_batch.is_cuda else 'cpu'
+        with torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.autocast):
+            mask = self.model.predict_mask(X_batch)
+
+        return mask.detach().cpu().numpy()
+
+    def _silent_patches(self, X_spec_pad, starts):
+        # A crop is silent when no bin of its whole context, mask offsets
+        # included, reaches `gate_db` relative to the normalized peak.
+        if self.gate_db is None:
+            return np.zeros(len(starts), dtype=bool)
+
+        frame_peak = np.abs(X_spec_pad).max(axis=(0, 1))
+        crop_peak = np.lib.stride_tricks.sliding_window_view(frame_peak, self.cropsize)[starts].max(axis=1)
+
+        return crop_peak < 10 ** (self.gate_db / 20)
+
+    def _smooth_gate(self, mask, silent, roi_size):
+        # Trivial masks are faded into the edge of a predicted neighbour so
+        # that the mask has no step at the gate boundaries.
+        fade = min(self.gate_fade, roi_size)
+        ramp = np.linspace(0, 1, fade + 1, dtype=np.float32)[1:]
+        for k in np.flatnonzero(silent):
+            start = k * roi_size
+            if k + 1 < len(silent) and not silent[k + 1]:
+                edge = mask[:, :, start + roi_size:start + roi_size + 1]
+                s = slice(start + roi_size - fade, start + roi_size)
+                mask[:, :, s] += (edge - mask[:, :, s]) * ramp
+            if k > 0 and not silent[k - 1]:
+                edge = mask[:, :, start - 1:start]
+                s = slice(start, start + fade)
+                mask[:, :, s] += (edge - mask[:, :, s]) * ramp[::-1]
+
+    def _separate(self, X_spec_pad, roi_size):
+        patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
+        starts = np.arange(patches) * roi_size
+
+        n_channel = 2 * X_spec_pad.shape[0]
+        dtype = np.complex64 if self.is_complex else np.float32
+        mask = np.empty((n_channel, X_spec_pad.shape[1], patches * roi_size), dtype=dtype)
+
+        silent = self._silent_patches(X_spec_pad, starts)
+        self.skipped = int(silent.sum())
+        if self.skipped > 0:
+            # all instruments, no vocals
+            for k in np.flatnonzero(silent):
+                mask[:n_channel // 2, :, k * roi_size:(k + 1) * roi_size] = 1
+                mask[n_channel // 2:, :, k * roi_size:(k + 1) * roi_size] = 0
+            starts = starts[~silent]
+
+        self.model.eval()
+        with torch.no_grad():
+            # To reduce the overhead, dataloader is not used.
+            n_batches = (len(starts) + self.batchsize - 1) // self.batchsize
+            batches = self._iter_batches(X_spec_pad, starts)
+            for i, X_batch in tqdm(batches, total=n_batches, disable=not self.progress):
+                mask_batch = self._predict_batch(X_batch)
+
+                for start, mask_crop in zip(starts[i:i + self.batchsize], mask_batch):
+                    mask[:, :, start:start + roi_size] = mask_crop
+
+        if self.gate_smooth and 0 < self.skipped < patches:
+            self._smooth_gate(mask, silent, roi_size)
+        self._report_gate(patches)
+
+        return mask
+
+    def _report_gate(self, patches):
+        if self.gate_db is not None and self.progress:
+            print('{} of {} patches below {} dB skipped'.format(self.skipped, patches, self.gate_db))
+
+    def _predict_mask(self, X_spec):
+        n_frame = X_spec.shape[2]
+        pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
+        X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
+        X_spec_pad /= np.abs(X_spec).max()
+
+        mask = self._separate(X_spec_pad, roi_size)
+
+        return mask[:, :, :n_frame]
+
+    def separate(self, X_spec):
+        mask = self._predict_mask(X_spec)
+
+        y_spec, v_spec = self._postprocess(X_spec, mask)
+
+        return y_spec, v_spec
+
+    def _predict_mask_tta(self, X_spec):
+        # the half-roi shifted crops do not line up with gated patches, so
+        # nothing is skipped here
+        self.skipped = 0
+        n_frame = X_spec.shape[2]
+        pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
+        # Both passes read one buffer padded for the half-roi shifted pass; the
+        # unshifted crops simply start roi_size // 2 frames later in it.
+        shift = roi_size // 2
+        X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l + shift, pad_r + shift)), mode='constant')
+        X_spec_pad /= X_spec_pad.max()
+
+        patches = (n_frame + pad_l + pad_r - 2 * self.offset) // roi_size
+        patches_tta = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
+        starts = np.sort(np.concatenate([
+            np.arange(patches) * roi_size + shift,
+            np.arange(patches_tta) * roi_size
+        ]))
+        # crop k covers output frames [starts[k] - shift, starts[k] - shift + roi_size)
+        starts = starts[starts - shift < n_frame]
+
+        self.model.eval()
+        with torch.no_grad():
+            mask = None
+            n_batches = (len(starts) + self.batchsize - 1) // self.batchsize
+            batches = self._iter_batches(X_spec_pad, starts)
+            for i, X_batch in tqdm(batches, total=n_batches, disable=not self.progress):
+                mask_batch = self._predict_batch(X_batch)
+
+                if mask is None:
+                    n_channel, n_bin, _ = mask_batch.shape[1:]
+                    mask = np.zeros((n_channel, n_bin, n_frame), dtype=mask_batch.dtype)
+
+                for start, mask_crop in zip(starts[i:i + self.batchsize], mask_batch):
+                    begin = start - shift
+                    s, e = max(begin, 0), min(begin + roi_size, n_frame)
+                    mask[:, :, s:e] += mask_crop[:, :, s - begin:e - begin] * 0.5
+
+        return mask
+
+    def separate_tta(self, X_spec):
+        mask = self._predict_mask_tta(X_spec)
+
+        y_spec, v_spec = self._postprocess(X_spec, mask)
+
+        return y_spec, v_spec
+
+    def separate_stream(self, spec_blocks, coef=None):
+        # Separates consecutive spectrogram blocks, keeping only one crop of
+        # context in memory. When `coef` is None the normalization uses a
+        # running maximum over the frames seen so far.
+        _, _, roi_size = dataset.make_padding(self.cropsize, self.cropsize, self.offset)
+        running_max = 0
+        X_buf = None
+
+        for X_spec in spec_blocks:
+            if X_buf is None:
+                X_buf = np.zeros(X_spec.shape[:2] + (self.offset,), dtype=X_spec.dtype)
+            X_buf = np.concatenate([X_buf, X_spec], axis=2)
+
+            # negative while the buffer is still shorter than the context
+            patches = (X_buf.shape[2] - 2 * self.offset) // roi_size
+            if patches <= 0:
+                continue
+
+            running_max = max(running_max, np.abs(X_buf).max())
+            n_frame = patches * roi_size
+            X_spec_pad = X_buf[:, :, :n_frame + 2 * self.offset]
+            yield self._separate_block(X_spec_pad, n_frame, roi_size, coef or running_max)
+            X_buf = X_buf[:, :, n_frame:]
+
+        if X_buf is None:
+            return
+
+        n_frame = X_buf.shape[2] - self.offset
+        if n_frame > 0:
+            _, pad_r, _ = dataset.make_padding(n_frame, self.cropsize, self.offset)
+            X_buf = np.pad(X_buf, ((0, 0), (0, 0), (0, pad_r)), mode='constant')
+            running_max = max(running_max, np.abs(X_buf).max())
+            yield self._separate_block(X_buf, n_frame, roi_size, coef or running_max)
+
+    def _separate_block(self, X_spec_pad, n_frame, roi_size, coef):
+        X_spec = X_spec_pad[:, :, self.offset:self.offset + n_frame]
+        if coef == 0:
+            # only silence so far (a running maximum of zero): dividing would
+            # give a NaN mask, so the block is passed through as instruments
+            return X_spec.copy(), np.zeros_like(X_spec)
+
+        mask = self._separate(X_spec_pad / coef, roi_size)
+        mask = mask[:, :, :n_frame]
+
+        return self._postprocess(X_spec, mask)
+
+    def separate_many(self, X_specs):
+        # Packs crops of consecutive songs into shared batches so that only the
+        # very last batch can be under-filled. Songs are yielded in input order
+        # as soon as all of their crops have been predicted. The silence gate
+        # is not applied on this path.
+        self.skipped = 0
+        batch = []
+
+        self.model.eval()
+        with torch.no_grad():
+            for key, X_spec in X_specs:
+                n_frame = X_spec.shape[2]
+                pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
+                X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
+                X_spec_pad /= np.abs(X_spec).max()
+
+                song = {
+                    'key': key,
+                    'X_spec': X_spec,
+                    'X_spec_pad': X_spec_pad,
+                    'roi_size': roi_size,
+                    'mask': None,
+                    'remaining': (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
+                }
+                for i in range(song['remaining']):
+                    batch.append((song, i))
+                    if len(batch) == self.batchsize:
+                        for song_done in self._separate_many_batch(batch):
+                            yield self._finish_song(song_done)
+                        batch = []
+
+            if len(batch) > 0:
+                for song_done in self._separate_many_batch(batch):
+                    yield self._finish_song(song_done)
+
+    def _separate_many_batch(self, batch):
+        X_batch = np.asarray([
+            song['X_spec_pad'][:, :, i * song['roi_size']:i * song['roi_size'] + self.cropsize]
+            for song, i in batch
+        ])
+        mask_batch = self._predict_batch(X_batch)
+
+        songs_done = []
+        for (song, i), mask_crop in zip(batch, mask_batch):
+            roi_size = song['roi_size']
+            if song['mask'] is None:
+                n_frame = song['X_spec_pad'].shape[2] - 2 * self.offset
+                song['mask'] = np.empty(mask_crop.shape[:2] + (n_frame,), dtype=mask_crop.dtype)
+
+            song['mask'][:, :, i * roi_size:(i + 1) * roi_size] = mask_crop
+            song['remaining'] -= 1
+            if song['remaining'] == 0:
+                songs_done.append(song)
+
+        return songs_done
+
+    def _finish_song(self, song):
+        X_spec = song['X_spec']
+        mask = song['mask'][:, :, :X_spec.shape[2]]
+        y_spec, v_spec = self._postprocess(X_spec, mask)
+
+        return song['key'], y_spec, v_spec
+
+
+def pin_worker(worker_ids, cores_per_worker):
+    # Pins a pool worker to its own slice of the cores. `worker_ids` is a
+    # shared counter (multiprocessing Value('i')) handing out the slices.
+    with worker_ids.get_lock():
+        worker_id = worker_ids.value
+        worker_ids.value += 1
+
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        cores = cores[worker_id * cores_per_worker:(worker_id + 1) * cores_per_worker]
+        if len(cores) > 0:
+            os.sched_setaffinity(0, cores)
+    torch.set_num_threads(cores_per_worker)
+
+
+_worker_separator = None
+
+
+def _init_shard_worker(model, batchsize, cropsize, precision, gate_db, worker_ids, cores_per_worker):
+    global _worker_separator
+
+    pin_worker(worker_ids, cores_per_worker)
+    if precision == 'int8':
+        # quantized modules cannot be sent to a spawned process
+        model = quantize(model)
+    _worker_separator = Separator(model, torch.device('cpu'), batchsize, cropsize, precision, gate_db)
+    _worker_separator.progress = False
+    # gate boundaries are smoothed once the shards are reassembled
+    _worker_separator.gate_smooth = False
+
+
+def _separate_shard(X_spec_pad, roi_size):
+    mask = _worker_separator._separate(X_spec_pad, roi_size)
+
+    return mask, _worker_separator.skipped
+
+
+class ShardedSeparator(Separator):
+
+    def __init__(
+            self, model, device=None, batchsize=1, cropsize=256, precision='fp32', gate_db=None, n_shards=2):
+        super(ShardedSeparator, self).__init__(model, device, batchsize, cropsize, precision, gate_db)
+        if device is not None and device.type != 'cpu':
+            raise ValueError('sharded separation is only available on CPU')
+        if isinstance(model, nets.ExportedNet):
+            raise ValueError('sharded separation is not available with exported models')
+        if is_quantized(model):
+            raise ValueError(
+                'sharded separation takes the fp32 model; with int8 precision every worker quantizes its own copy'
+            )
+
+        self.n_shards = n_shards
+        if hasattr(os, 'sched_getaffinity'):
+            n_cores = len(os.sched_getaffinity(0))
+        else:
+            n_cores = os.cpu_count()
+        cores_per_worker = max(n_cores // n_shards, 1)
+
+        # Workers are spawned with their own thread pools and core slices. The
+        # weights are moved to shared memory once, so every worker maps the
+        # same read-only copy instead of unpickling its own.
+        model.share_memory()
+        ctx = torch.multiprocessing.get_context('spawn')
+        self._executor = futures.ProcessPoolExecutor(
+            max_workers=n_shards,
+            mp_context=ctx,
+            initializer=_init_shard_worker,
+            initargs=(
+                model, batchsize, cropsize, precision, gate_db,
+                ctx.Value('i', 0), cores_per_worker
+            )
+        )
+        if precision == 'int8':
+            # for the TTA and cross-song paths, which run in this process
+            self.model = quantize(model)
+
+    def _separate(self, X_spec_pad, roi_size):
+        patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
+        bounds = np.linspace(0, patches, min(self.n_shards, patches) + 1).astype(int)
+
+        # shard k predicts patches [bounds[k], bounds[k + 1]) and needs the
+        # offset frames of context on both sides of its range
+        jobs = [
+            self._executor.submit(
+                _separate_shard,
+                X_spec_pad[:, :, p0 * roi_size:p1 * roi_size + 2 * self.offset],
+                roi_size
+            )
+            for p0, p1 in zip(bounds[:-1], bounds[1:])
+        ]
+        masks, skipped = zip(*[job.result() for job in tqdm(jobs, disable=not self.progress)])
+        mask = np.concatenate(masks, axis=2)
+
+        self.skipped = sum(skipped)
+        if self.gate_smooth and 0 < self.skipped < patches:
+            starts = np.arange(patches) * roi_size
+            self._smooth_gate(mask, self._silent_patches(X_spec_pad, starts), roi_size)
+        self._report_gate(patches)
+
+        return mask
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
+
+
+def get_device(gpu=-1):
+    device = torch.device('cpu')
+    if gpu >= 0:
+        if torch.cuda.is_available():
+            device = torch.device('cuda:{}'.format(gpu))
+        elif torch.backends.mps.is_available() and torch.backends.mps.is_built():
+            device = torch.device('mps')
+
+    return device
+
+
+def quantize(model):
+    # weights of the LSTM and Linear layers are stored as int8 and
+    # activations are quantized on the fly; convolutions stay in fp32
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def is_quantized(model):
+    dynamic = torch.ao.nn.quantized.dynamic
+
+    return any(isinstance(m, (dynamic.Linear, dynamic.LSTM)) for m in model.modules())
+
+
+def load_model(
+        pretrained_model, n_fft=2048, hop_length=1024, is_complex=False, device=None, precision='fp32'):
+    if pretrained_model.endswith('.jit'):
+        # artifacts written by export.py carry their own STFT parameters
+        if precision != 'fp32':
+            raise ValueError('{} precision is not available with exported models'.format(precision))
+        return nets.load_exported_model(pretrained_model, device)
+
+    model = nets.CascadedNet(n_fft, hop_length, 32, 128, is_complex)
+    model.load_state_dict(torch.load(pretrained_model, map_location='cpu'))
+    model.eval()
+
+    if precision == 'int8':
+        if device is not None and device.type != 'cpu':
+            raise ValueError('int8 precision is only available on CPU')
+        model = quantize(model)
+
+    model.to(device)
+
+    return model
+
+
+def mask_error(sp, sp_ref, X_spec):
+    mask = sp._predict_mask(X_spec)
+    mask_ref = sp_ref._predict_mask(X_spec)
+    error = np.abs(mask - mask_ref)
+
+    return error.max(), error.mean()
+
+
+def load_wave(input_path, sr=44100):
+    X, sr = audio.load(input_path, sr)
+
+    if X.ndim == 1:
+        # mono to stereo
+        X = np.asarray([X, X])
+
+    return X, sr
+
+
+STEMS = ('Instruments', 'Vocals')
+MIX_STEMS = ('Merged', 'Vocals')
+
+
+def stem_specs(y_spec, v_spec, stems=STEMS, mix_gain=0):
+    # The karaoke mix is built in the spectral domain, so that it needs a
+    # single inverse STFT instead of two stems summed after decoding.
+    specs = {'Instruments': y_spec, 'Vocals': v_spec}
+    if 'Merged' in stems:
+        specs['Merged'] = y_spec + mix_gain * v_spec if mix_gain != 0 else y_spec
+
+    return [specs[stem] for stem in stems]
+
+
+def write_stems(
+        y_spec, v_spec, output_dir, basename, sr, hop_length, output_image=False,
+        stems=STEMS, mix_gain=0):
+    if output_dir != '':
+        os.makedirs(output_dir, exist_ok=True)
+
+    print('inverse stft of {}...'.format(', '.join(stems).lower()), end=' ')
+    waves = spec_utils.spectrogram_to_wave(
+        np.asarray(stem_specs(y_spec, v_spec, stems, mix_gain)), hop_length=hop_length
+    )
+    print('done')
+
+    paths = []
+    for stem, wave in zip(stems, waves):
+        path = os.path.join(output_dir, '{}_{}.wav'.format(basename, stem))
+        sf.write(path, wave.T, sr)
+        paths.append(path)
+
+    if output_image:
+        image = spec_utils.spectrogram_to_image(y_spec)
+        utils.imwrite(os.path.join(output_dir, '{}_Instruments.jpg'.format(basename)), image)
+
+        image = spec_utils.spectrogram_to_image(v_spec)
+        utils.imwrite(os.path.join(output_dir, '{}_Vocals.jpg'.format(basename)), image)
+
+    return tuple(paths)
+
+
+def separate_file(
+        sp, input_path, output_dir='', basename=None, sr=44100, tta=False, output_image=False,
+        stems=STEMS, mix_gain=0):
+    print('loading wave source...', end=' ')
+    X, sr = load_wave(input_path, sr)
+    if basename is None:
+        basename = os.path.splitext(os.path.basename(input_path))[0]
+    print('done')
+
+    return separate_wave(sp, X, output_dir, basename, sr, tta, output_image, stems, mix_gain)
+
+
+def separate_wave(
+        sp, X, output_dir, basename, sr=44100, tta=False, output_image=False,
+        stems=STEMS, mix_gain=0):
+    n_fft = sp.model.n_fft
+    hop_length = sp.model.hop_length
+
+    print('stft of wave source...', end=' ')
+    X_spec = spec_utils.wave_to_spectrogram(X, hop_length, n_fft)
+    print('done')
+
+    if tta:
+        y_spec, v_spec = sp.separate_tta(X_spec)
+    else:
+        y_spec, v_spec = sp.separate(X_spec)
+
+    return write_stems(
+        y_spec, v_spec, output_dir, basename, sr, hop_length, output_image, stems, mix_gain
+    )
+
+
+def separate_files(sp, input_paths, output_dir='', sr=44100, stems=STEMS, mix_gain=0):
+    def waves():
+        for input_path in input_paths:
+            print('loading {}...'.format(input_path), end=' ')
+            X, _ = load_wave(input_path, sr)
+            print('done')
+            yield os.path.splitext(os.path.basename(input_path))[0], X
+
+    return separate_waves(sp, waves(), output_dir, sr, stems, mix_gain)
+
+
+def separate_waves(sp, waves, output_dir='', sr=44100, stems=STEMS, mix_gain=0):
+    n_fft = sp.model.n_fft
+    hop_length = sp.model.hop_length
+
+    def X_specs():
+        for basename, X in waves:
+            yield basename, spec_utils.wave_to_spectrogram(X, hop_length, n_fft)
+
+    outputs = []
+    for basename, y_spec, v_spec in sp.separate_many(X_specs()):
+        outputs.append(write_stems(
+            y_spec, v_spec, output_dir, basename, sr, hop_length, stems=stems, mix_gain=mix_gain
+        ))
+
+    return outputs
+
+
+def separate_file_stream(
+        sp, input_path, output_dir='', basename=None, sr=44100, block_seconds=30, normalization='prescan',
+        stems=STEMS, mix_gain=0):
+    n_fft = sp.model.n_fft
+    hop_length = sp.model.hop_length
+    block_size = int(block_seconds * sr)
+
+    if basename is None:
+        basename = os.path.splitext(os.path.basename(input_path))[0]
+
+    def spec_blocks():
+        stft = streaming.STFTStream(n_fft, hop_length)
+        for wave in streaming.read_blocks(input_path, sr, block_size):
+            yield stft.push(wave)
+        yield stft.flush()
+
+    coef = None
+    if normalization == 'prescan':
+        print('scanning wave source...', end=' ')
+        coef = max(np.abs(X_spec).max(initial=0) for X_spec in spec_blocks())
+        print('done')
+
+    if output_dir != '':
+        os.makedirs(output_dir, exist_ok=True)
+
+    paths = [os.path.join(output_dir, '{}_{}.wav'.format(basename, stem)) for stem in stems]
+    istfts = [streaming.ISTFTStream(n_fft, hop_length) for _ in stems]
+
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(sf.SoundFile(path, 'w', sr, 2)) for path in paths]
+        for y_spec, v_spec in sp.separate_stream(spec_blocks(), coef):
+            for f, istft, spec in zip(files, istfts, stem_specs(y_spec, v_spec, stems, mix_gain)):
+                f.write(istft.push(spec).T)
+
+        for f, istft in zip(files, istfts):
+            f.write(istft.flush().T)
+
+    return tuple(paths)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--gpu', '-g', type=int, default=-1)
+    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
+    p.add_argument('--input', '-i', nargs='+', required=True)
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--batchsize', '-B', type=int, default=4)
+    p.add_argument('--cropsize', '-c', type=int, default=256)
+    p.add_argument('--output_image', '-I', action='store_true')
+    p.add_argument('--tta', '-t', action='store_true')
+    p.add_argument('--output_dir', '-o', type=str, default="")
+    p.add_argument('--complex', '-X', action='store_true')
+    p.add_argument('--precision', '-p', type=str, choices=['fp32', 'int8', 'bf16'], default='fp32')
+    p.add_argument('--check_precision', type=float, default=0)
+    p.add_argument('--shards', type=int, default=1)
+    p.add_argument('--mix_gain', type=float, default=None)
+    p.add_argument(
+        '--gate_db', type=float, default=None,
+        help='skip patches below this level (dB from the peak); not applied with --tta or to batched multiple inputs'
+    )
+    p.add_argument('--stream', '-s', action='store_true')
+    p.add_argument('--stream_block', type=float, default=30)
+    p.add_argument('--stream_norm', type=str, choices=['prescan', 'running'], default='prescan')
+    args = p.parse_args()
+
+    if args.stream and (args.tta or args.output_image):
+        raise ValueError('`--tta` and `--output_image` options are not available with `--stream` mode')
+
+    print('loading model...', end=' ')
+    device = get_device(args.gpu)
+    model = load_model(
+        args.pretrained_model, args.n_fft, args.hop_length, args.complex, device,
+        # sharded int8 workers quantize the fp32 weights themselves
+        args.precision if args.shards == 1 else 'fp32'
+    )
+    print('done')
+
+    if args.shards > 1:
+        # patches of one song are split across worker processes
+        sp = ShardedSeparator(
+            model=model,
+            device=device,
+            batchsize=args.batchsize,
+            cropsize=args.cropsize,
+            precision=args.precision,
+            gate_db=args.gate_db,
+            n_shards=args.shards
+        )
+    else:
+        sp = Separator(
+            model=model,
+            device=device,
+            batchsize=args.batchsize,
+            cropsize=args.cropsize,
+            precision=args.precision,
+            gate_db=args.gate_db
+        )
+
+    if args.check_precision > 0 and args.precision != 'fp32':
+        # mask error against the fp32 model on the head of the first input
+        model_ref = load_model(args.pretrained_model, args.n_fft, args.hop_length, args.complex, device)
+        sp_ref = Separator(model_ref, device, args.batchsize, args.cropsize)
+
+        X, _ = load_wave(args.input[0], args.sr)
+        X = X[:, :int(args.check_precision * args.sr)]
+        X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
+        print('mask error against fp32 (max, mean): ({:.6f}, {:.6f})'.format(
+            *mask_error(sp, sp_ref, X_spec)
+        ))
+
+    stems, mix_gain = STEMS, 0
+    if args.mix_gain is not None:
+        # karaoke mix of instruments and attenuated vocals instead of the instruments stem
+        stems, mix_gain = MIX_STEMS, args.mix_gain
+
+    if args.stream:
+        for input_path in args.input:
+            separate_file_stream(
+                sp, input_path,
+                output_dir=args.output_dir,
+                sr=args.sr,
+                block_seconds=args.stream_block,
+                normalization=args.stream_norm,
+                stems=stems,
+                mix_gain=mix_gain
+            )
+    elif len(args.input) > 1 and not (args.tta or args.output_image):
+        # patches of several songs share forward batches
+        separate_files(
+            sp, args.input,
+            output_dir=args.output_dir,
+            sr=args.sr,
+            stems=stems,
+            mix_gain=mix_gain
+        )
+    else:
+        for input_path in args.input:
+            separate_file(
+                sp, input_path,
+                output_dir=args.output_dir,
+                sr=args.sr,
+                tta=args.tta,
+                output_image=args.output_image,
+                stems=stems,
+                mix_gain=mix_gain
+            )
+
+    if args.shards > 1:
+        sp.close()
+
+
+if __name__ == '__main__':
+    main()
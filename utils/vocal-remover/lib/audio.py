@@ -0,0 +1,142 @@
+import collections
+import json
+import os
+import subprocess
+import threading
+
+import numpy as np
+import soundfile as sf
+import soxr
+
+
+def _probe(path):
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries', 'stream=sample_rate,channels:format=duration',
+        '-of', 'json', path
+    ]
+    info = json.loads(subprocess.run(cmd, capture_output=True, check=True).stdout)
+    stream = info['streams'][0]
+
+    return int(stream['sample_rate']), int(stream['channels']), float(info['format'].get('duration', 0))
+
+
+def _decode_soundfile(path):
+    with sf.SoundFile(path) as f:
+        # a view of the frames actually read is returned
+        wave = f.read(out=np.empty((f.frames, f.channels), dtype=np.float32))
+
+        return wave, f.samplerate
+
+
+def _decode_ffmpeg(path):
+    sr, channels, duration = _probe(path)
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-i', path, '-map', '0:a:0', '-f', 'f32le', '-']
+
+    # the duration is only an estimate, the buffer grows if the stream is longer
+    wave = np.empty((int(duration * sr) + sr, channels), dtype=np.float32)
+    n_byte = 0
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as p:
+        while True:
+            if n_byte == wave.nbytes:
+                wave = np.concatenate([wave, np.empty_like(wave)])
+            n = p.stdout.readinto(memoryview(wave).cast('B')[n_byte:])
+            if not n:
+                break
+            n_byte += n
+
+    if p.returncode != 0:
+        raise RuntimeError('ffmpeg failed to decode {}'.format(path))
+
+    return wave[:n_byte // (4 * channels)], sr
+
+
+def decode(path):
+    # (n_sample, n_channel) float32 at the native rate of the file
+    try:
+        return _decode_soundfile(path)
+    except sf.LibsndfileError:
+        return _decode_ffmpeg(path)
+
+
+def resample(wave, orig_sr, target_sr):
+    # wave: (n_channel, n_sample)
+    if orig_sr == target_sr:
+        return wave
+
+    return soxr.resample(wave.T, orig_sr, target_sr).T
+
+
+class DecodeCache(object):
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.n_byte = 0
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+
+            return self.entries[key]
+
+    def put(self, key, wave, sr):
+        # shared buffers must not be modified by any stage
+        wave.flags.writeable = False
+        with self._lock:
+            if key in self.entries:
+                return
+            self.entries[key] = wave, sr
+            self.n_byte += wave.nbytes
+            while self.n_byte > self.max_bytes and len(self.entries) > 1:
+                _, (old, _) = self.entries.popitem(last=False)
+                self.n_byte -= old.nbytes
+
+
+_cache = DecodeCache(int(os.getenv('DECODE_CACHE_SIZE_MB', '1024')) << 20)
+
+
+def _decode_cached(path, sr):
+    st = os.stat(path)
+    file_key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+
+    native = _cache.get(file_key + (None,))
+    if native is None:
+        wave, native_sr = decode(path)
+        native = wave.T, native_sr
+        _cache.put(file_key + (None,), *native)
+
+    wave, orig_sr = native
+    if sr is None or sr == orig_sr:
+        return native
+
+    resampled = _cache.get(file_key + (sr,))
+    if resampled is None:
+        resampled = resample(wave, orig_sr, sr), sr
+        _cache.put(file_key + (sr,), *resampled)
+
+    return resampled
+
+
+def load(path, sr=None, mono=False, cache=True):
+    # Decoded float32 buffers are shared between the stages of a job. They
+    # are keyed by the file identity and the requested rate, so a file is
+    # decoded once and resampled at most once per rate. Batch tools that
+    # read every file once pass cache=False.
+    if cache:
+        wave, sr = _decode_cached(path, sr)
+    else:
+        wave, orig_sr = decode(path)
+        wave = resample(wave.T, orig_sr, sr or orig_sr)
+        sr = sr or orig_sr
+
+    # (n_channel, n_sample), or (n_sample,) for mono as in librosa.load
+    if mono:
+        wave = wave.mean(axis=0)
+    elif wave.shape[0] == 1:
+        wave = wave[0]
+
+    return wave, sr
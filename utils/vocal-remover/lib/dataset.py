@@ -1,323 +1,592 @@
-import os
-import random
-
-import numpy as np
-import torch
-import torch.utils.data
-from tqdm import tqdm
-
-try:
-    from lib import spec_utils
-except ModuleNotFoundError:
-    import spec_utils
-
-
-class VocalRemoverTrainingSet(torch.utils.data.Dataset):
-
-    def __init__(
-            self, training_set, cropsize, reduction_rate, reduction_weight,
-            mixup_rate, mixup_alpha, is_complex=False):
-        self.training_set = training_set
-        self.cropsize = cropsize
-        self.reduction_rate = reduction_rate
-        self.reduction_weight = reduction_weight
-        self.mixup_rate = mixup_rate
-        self.mixup_alpha = mixup_alpha
-        self.is_complex = is_complex
-
-    def __len__(self):
-        return len(self.training_set)
-
-    def read_npy_shape(self, path):
-        with open(path, 'rb') as fhandle:
-            _, _ = np.lib.format.read_magic(fhandle)
-            shape, _, _ = np.lib.format.read_array_header_1_0(fhandle)
-            return shape
-
-    def read_npy_chunk(self, path, start_row):
-        with open(path, 'rb') as fhandle:
-            _, _ = np.lib.format.read_magic(fhandle)
-            shape, fortran, dtype = np.lib.format.read_array_header_1_0(fhandle)
-
-            assert not fortran, 'Fortran order arrays are not supported'
-
-            row_size = np.prod(shape[1:])
-            start_byte = start_row * row_size * dtype.itemsize
-            fhandle.seek(start_byte, 1)
-            n_items = row_size * self.cropsize
-            flat = np.fromfile(fhandle, count=n_items, dtype=dtype)
-
-            return flat.reshape((-1,) + shape[1:])
-
-    def aggressively_remove_vocal(self, X, y):
-        X_mag = np.abs(X)
-        y_mag = np.abs(y)
-        v_mag = X_mag - y_mag
-        v_mag *= v_mag > y_mag
-
-        y_mag = np.clip(y_mag - v_mag * self.reduction_weight, 0, np.inf)
-
-        return y_mag * np.exp(1.j * np.angle(y))
-
-    def do_crop(self, X_path, y_path, v_path):
-        shape = self.read_npy_shape(X_path)
-        start_row = np.random.randint(0, shape[0] - self.cropsize)
-
-        X_crop = self.read_npy_chunk(X_path, start_row).transpose(1, 2, 0)
-        y_crop = self.read_npy_chunk(y_path, start_row).transpose(1, 2, 0)
-        v_crop = self.read_npy_chunk(v_path, start_row).transpose(1, 2, 0)
-
-        return X_crop, y_crop, v_crop
-
-    def do_aug(self, X, y, v):
-        if np.random.uniform() < self.reduction_rate:
-            y = self.aggressively_remove_vocal(X, y)
-
-        if np.random.uniform() < 0.5:
-            # swap channel
-            X = X[::-1].copy()
-            y = y[::-1].copy()
-            v = v[::-1].copy()
-
-        if np.random.uniform() < 0.01:
-            # inst
-            X = y.copy()
-            v = np.zeros_like(X)
-
-        # if np.random.uniform() < 0.01:
-        #     # mono
-        #     X[:] = X.mean(axis=0, keepdims=True)
-        #     y[:] = y.mean(axis=0, keepdims=True)
-
-        return X, y, v
-
-    def do_mixup(self, X, y, v):
-        idx = np.random.randint(0, len(self))
-        X_path, y_path, v_path, coef = self.training_set[idx]
-
-        X_i, y_i, v_i = self.do_crop(X_path, y_path, v_path)
-        X_i /= coef
-        y_i /= coef
-        v_i /= coef
-
-        X_i, y_i, v_i = self.do_aug(X_i, y_i, v_i)
-
-        lam = np.random.beta(self.mixup_alpha, self.mixup_alpha)
-        X = lam * X + (1 - lam) * X_i
-        y = lam * y + (1 - lam) * y_i
-        v = lam * v + (1 - lam) * v_i
-
-        return X, y, v
-
-    def __getitem__(self, idx):
-        X_path, y_path, v_path, coef = self.training_set[idx]
-
-        X, y, v = self.do_crop(X_path, y_path, v_path)
-        X /= coef
-        y /= coef
-        v /= coef
-
-        X, y, v = self.do_aug(X, y, v)
-
-        if np.random.uniform() < self.mixup_rate:
-            X, y, v = self.do_mixup(X, y, v)
-
-        if self.is_complex:
-            y = np.concatenate([y, v])
-            return X, y
-        else:
-            X_mag = np.abs(X)
-            y_mag = np.abs(np.concatenate([y, v]))
-            return X_mag, y_mag
-
-
-class VocalRemoverValidationSet(torch.utils.data.Dataset):
-
-    def __init__(self, validation_set, is_complex=False):
-        self.validation_set = validation_set
-        self.is_complex = is_complex
-
-    def __len__(self):
-        return len(self.validation_set)
-
-    def __getitem__(self, idx):
-        path = self.validation_set[idx]
-        data = np.load(path)
-
-        X, y, v = data['X'], data['y'], data['v']
-
-        if self.is_complex:
-            y = np.concatenate([y, v])
-            return X, y
-        else:
-            X_mag = np.abs(X)
-            y_mag = np.abs(np.concatenate([y, v]))
-            return X_mag, y_mag
-
-
-def make_pair(X_dir, y_dir, v_dir=None):
-    input_exts = ['.wav', '.m4a', '.mp3', '.mp4', '.flac']
-
-    X_list = sorted([
-        os.path.join(X_dir, fname)
-        for fname in os.listdir(X_dir)
-        if os.path.splitext(fname)[1] in input_exts
-    ])
-    y_list = sorted([
-        os.path.join(y_dir, fname)
-        for fname in os.listdir(y_dir)
-        if os.path.splitext(fname)[1] in input_exts
-    ])
-
-    if v_dir is not None:
-        v_list = sorted([
-            os.path.join(v_dir, fname)
-            for fname in os.listdir(v_dir)
-            if os.path.splitext(fname)[1] in input_exts
-        ])
-        filelist = list(zip(X_list, y_list, v_list))
-    else:
-        filelist = list(zip(X_list, y_list))
-
-    return filelist
-
-
-def train_val_split(dataset_dir, split_mode, val_rate, val_filelist=[]):
-    if split_mode == 'random':
-        filelist = make_pair(
-            os.path.join(dataset_dir, 'mixtures'),
-            os.path.join(dataset_dir, 'instruments'),
-            os.path.join(dataset_dir, 'pseudo_vocals')
-        )
-
-        random.shuffle(filelist)
-
-        if len(val_filelist) == 0:
-            val_size = int(len(filelist) * val_rate)
-            train_filelist = filelist[:-val_size]
-            val_filelist = filelist[-val_size:]
-        else:
-            train_filelist = [
-                pair for pair in filelist
-                if list(pair) not in val_filelist
-            ]
-    elif split_mode == 'subdirs':
-        if len(val_filelist) != 0:
-            raise ValueError('`val_filelist` option is not available with `subdirs` mode')
-
-        train_filelist = make_pair(
-            os.path.join(dataset_dir, 'training/mixtures'),
-            os.path.join(dataset_dir, 'training/instruments'),
-            os.path.join(dataset_dir, 'training/pseudo_vocals')
-        )
-
-        val_filelist = make_pair(
-            os.path.join(dataset_dir, 'validation/mixtures'),
-            os.path.join(dataset_dir, 'validation/instruments'),
-            os.path.join(dataset_dir, 'validation/pseudo_vocals')
-        )
-
-    return train_filelist, val_filelist
-
-
-def raw_data_split(dataset_dir, split_mode):
-    if split_mode == 'random':
-        filelist = make_pair(
-            os.path.join(dataset_dir, 'mixtures'),
-            os.path.join(dataset_dir, 'instruments'),
-        )
-    elif split_mode == 'subdirs':
-        train_filelist = make_pair(
-            os.path.join(dataset_dir, 'training/mixtures'),
-            os.path.join(dataset_dir, 'training/instruments'),
-        )
-        val_filelist = make_pair(
-            os.path.join(dataset_dir, 'validation/mixtures'),
-            os.path.join(dataset_dir, 'validation/instruments'),
-        )
-        filelist = train_filelist + val_filelist
-
-    return filelist
-
-
-def make_padding(width, cropsize, offset):
-    left = offset
-    roi_size = cropsize - offset * 2
-    if roi_size == 0:
-        roi_size = cropsize
-    right = roi_size - (width % roi_size) + left
-
-    return left, right, roi_size
-
-
-def make_training_set(filelist, sr, hop_length, n_fft):
-    ret = []
-    for X_path, y_path, v_path in tqdm(filelist):
-        X, y, v, X_cache_path, y_cache_path, v_cache_path = spec_utils.cache_or_load(
-            X_path, y_path, v_path, sr, hop_length, n_fft
-        )
-        coef = np.max([np.abs(X).max(), np.abs(y).max(), np.abs(v).max()])
-        ret.append([X_cache_path, y_cache_path, v_cache_path, coef])
-
-    return ret
-
-
-def make_validation_set(filelist, cropsize, sr, hop_length, n_fft, offset):
-    patch_list = []
-    patch_dir = 'cs{}_sr{}_hl{}_nf{}_of{}'.format(cropsize, sr, hop_length, n_fft, offset)
-    os.makedirs(patch_dir, exist_ok=True)
-
-    for X_path, y_path, v_path in tqdm(filelist):
-        basename = os.path.splitext(os.path.basename(X_path))[0]
-
-        X, y, v, _, _, _ = spec_utils.cache_or_load(X_path, y_path, v_path, sr, hop_length, n_fft)
-        coef = np.max([np.abs(X).max(), np.abs(y).max(), np.abs(v).max()])
-        X, y, v = X / coef, y / coef, v / coef
-
-        l, r, roi_size = make_padding(X.shape[2], cropsize, offset)
-        X_pad = np.pad(X, ((0, 0), (0, 0), (l, r)), mode='constant')
-        y_pad = np.pad(y, ((0, 0), (0, 0), (l, r)), mode='constant')
-        v_pad = np.pad(v, ((0, 0), (0, 0), (l, r)), mode='constant')
-
-        len_dataset = int(np.ceil(X.shape[2] / roi_size))
-        for j in range(len_dataset):
-            outpath = os.path.join(patch_dir, '{}_p{}.npz'.format(basename, j))
-            start = j * roi_size
-            if not os.path.exists(outpath):
-                np.savez(
-                    outpath,
-                    X=X_pad[:, :, start:start + cropsize],
-                    y=y_pad[:, :, start:start + cropsize],
-                    v=v_pad[:, :, start:start + cropsize]
-                )
-            patch_list.append(outpath)
-
-    return patch_list
-
-
-if __name__ == "__main__":
-    import sys
-    import utils
-
-    mix_dir = sys.argv[1]
-    inst_dir = sys.argv[2]
-    outdir = sys.argv[3]
-
-    os.makedirs(outdir, exist_ok=True)
-
-    filelist = make_pair(mix_dir, inst_dir)
-    for mix_path, inst_path in tqdm(filelist):
-        mix_basename = os.path.splitext(os.path.basename(mix_path))[0]
-
-        X_spec, y_spec, _, _ = spec_utils.cache_or_load(
-            mix_path, inst_path, 44100, 1024, 2048
-        )
-
-        X_mag = np.abs(X_spec)
-        y_mag = np.abs(y_spec)
-        v_mag = X_mag - y_mag
-        v_mag *= v_mag > y_mag
-
-        outpath = '{}/{}_Vocal.jpg'.format(outdir, mix_basename)
-        v_image = spec_utils.spectrogram_to_image(v_mag)
-        utils.imwrite(outpath, v_image)
+import collections
+import json
+import multiprocessing
+import os
+import random
+from concurrent import futures
+
+import numpy as np
+import torch
+import torch.utils.data
+from tqdm import tqdm
+
+try:
+    from lib import spec_utils
+except ModuleNotFoundError:
+    import spec_utils
+
+
+class VocalRemoverTrainingSet(torch.utils.data.Dataset):
+
+    # memory-mapped cache files kept open per process; each holds a descriptor
+    max_open_files = 64
+
+    def __init__(
+            self, training_set, cropsize, reduction_rate, reduction_weight,
+            mixup_rate, mixup_alpha, is_complex=False, batch_aug=False):
+        self.training_set = training_set
+        self.cropsize = cropsize
+        self.reduction_rate = reduction_rate
+        self.reduction_weight = reduction_weight
+        self.mixup_rate = mixup_rate
+        self.mixup_alpha = mixup_alpha
+        self.is_complex = is_complex
+        self.batch_aug = batch_aug
+        self._mmaps = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.training_set)
+
+    def __getstate__(self):
+        # DataLoader workers start with no mapping and open their own
+        state = self.__dict__.copy()
+        state['_mmaps'] = collections.OrderedDict()
+        return state
+
+    def open_npy(self, path):
+        # Cache files are memory-mapped once per process and crops are views
+        # into the mapping. Only the most recently used `max_open_files` stay
+        # mapped; the page cache keeps evicted files cheap to map again.
+        if path in self._mmaps:
+            self._mmaps.move_to_end(path)
+        else:
+            self._mmaps[path] = np.load(path, mmap_mode='r')
+            while len(self._mmaps) > self.max_open_files:
+                self._mmaps.popitem(last=False)
+
+        return self._mmaps[path]
+
+    def aggressively_remove_vocal(self, X, y):
+        X_mag = np.abs(X)
+        y_mag = np.abs(y)
+        v_mag = X_mag - y_mag
+        v_mag *= v_mag > y_mag
+
+        y_mag = np.clip(y_mag - v_mag * self.reduction_weight, 0, np.inf)
+
+        return y_mag * np.exp(1.j * np.angle(y))
+
+    def do_crop(self, X_path, y_path, v_path):
+        X, y, v = self.open_npy(X_path), self.open_npy(y_path), self.open_npy(v_path)
+        start_row = np.random.randint(0, X.shape[0] - self.cropsize)
+        end_row = start_row + self.cropsize
+
+        # read-only views; the first arithmetic on them makes the copy
+        X_crop = X[start_row:end_row].transpose(1, 2, 0)
+        y_crop = y[start_row:end_row].transpose(1, 2, 0)
+        v_crop = v[start_row:end_row].transpose(1, 2, 0)
+
+        return X_crop, y_crop, v_crop
+
+    def do_aug(self, X, y, v):
+        if np.random.uniform() < self.reduction_rate:
+            y = self.aggressively_remove_vocal(X, y)
+
+        if np.random.uniform() < 0.5:
+            # swap channel
+            X = X[::-1].copy()
+            y = y[::-1].copy()
+            v = v[::-1].copy()
+
+        if np.random.uniform() < 0.01:
+            # inst
+            X = y.copy()
+            v = np.zeros_like(X)
+
+        # if np.random.uniform() < 0.01:
+        #     # mono
+        #     X[:] = X.mean(axis=0, keepdims=True)
+        #     y[:] = y.mean(axis=0, keepdims=True)
+
+        return X, y, v
+
+    def load_crop(self, idx):
+        X_path, y_path, v_path, coef = self.training_set[idx]
+
+        X, y, v = self.do_crop(X_path, y_path, v_path)
+        X = X / coef
+        y = y / coef
+        v = v / coef
+
+        return X, y, v
+
+    def do_mixup(self, X, y, v):
+        idx = np.random.randint(0, len(self))
+        X_i, y_i, v_i = self.load_crop(idx)
+
+        X_i, y_i, v_i = self.do_aug(X_i, y_i, v_i)
+
+        lam = np.random.beta(self.mixup_alpha, self.mixup_alpha)
+        X = lam * X + (1 - lam) * X_i
+        y = lam * y + (1 - lam) * y_i
+        v = lam * v + (1 - lam) * v_i
+
+        return X, y, v
+
+    def __getitem__(self, idx):
+        X, y, v = self.load_crop(idx)
+
+        if self.batch_aug:
+            # Crops are returned as they are and BatchAugmentation is applied
+            # to the whole batch. Only the mixup partner is drawn here, since
+            # it decides what has to be read; None when mixup is not drawn.
+            partner = None
+            if np.random.uniform() < self.mixup_rate:
+                partner = self.load_crop(np.random.randint(0, len(self)))
+            return X, y, v, partner
+
+        X, y, v = self.do_aug(X, y, v)
+
+        if np.random.uniform() < self.mixup_rate:
+            X, y, v = self.do_mixup(X, y, v)
+
+        if self.is_complex:
+            y = np.concatenate([y, v])
+            return X, y
+        else:
+            X_mag = np.abs(X)
+            y_mag = np.abs(np.concatenate([y, v]))
+            return X_mag, y_mag
+
+
+class BatchAugmentation(object):
+
+    def __init__(self, reduction_rate, reduction_weight, mixup_alpha, is_complex=False):
+        self.reduction_rate = reduction_rate
+        self.reduction_weight = torch.from_numpy(reduction_weight)
+        self.mixup_alpha = mixup_alpha
+        self.is_complex = is_complex
+
+    def draw(self, rate, X):
+        # indices of the samples for which an augmentation is drawn
+        return torch.nonzero(torch.rand(len(X), device=X.device) < rate).squeeze(1)
+
+    def aggressively_remove_vocal(self, X, y):
+        X_mag = torch.abs(X)
+        y_mag = torch.abs(y)
+        v_mag = X_mag - y_mag
+        v_mag *= v_mag > y_mag
+
+        weight = self.reduction_weight.to(X.device)
+        y_mag_new = torch.clamp(y_mag - v_mag * weight, min=0)
+
+        # rescaling keeps the phase of y without going through angle and polar
+        scale = torch.where(y_mag > 0, y_mag_new / y_mag, torch.zeros_like(y_mag))
+        return y * scale
+
+    def do_aug(self, X, y, v):
+        # only the selected samples are computed and written, in place
+        idx = self.draw(self.reduction_rate, X)
+        if len(idx) > 0:
+            y[idx] = self.aggressively_remove_vocal(X[idx], y[idx])
+
+        idx = self.draw(0.5, X)
+        if len(idx) > 0:
+            # swap channel
+            X[idx] = X[idx].flip(1)
+            y[idx] = y[idx].flip(1)
+            v[idx] = v[idx].flip(1)
+
+        idx = self.draw(0.01, X)
+        if len(idx) > 0:
+            # inst
+            X[idx] = y[idx]
+            v[idx] = 0
+
+        return X, y, v
+
+    def __call__(self, X, y, v, X_i, y_i, v_i, idx):
+        # The draws of VocalRemoverTrainingSet.do_aug and do_mixup, made per
+        # sample and applied to the batch tensors, which are modified in place.
+        # X_i, y_i and v_i hold the partners of the samples at `idx` only, as
+        # stacked by collate_batch_aug.
+        X, y, v = self.do_aug(X, y, v)
+
+        if len(idx) > 0:
+            X_i, y_i, v_i = self.do_aug(X_i, y_i, v_i)
+
+            beta = torch.distributions.Beta(float(self.mixup_alpha), float(self.mixup_alpha))
+            lam = beta.sample((len(idx),)).to(X.device)[:, None, None, None]
+            X[idx] = lam * X[idx] + (1 - lam) * X_i
+            y[idx] = lam * y[idx] + (1 - lam) * y_i
+            v[idx] = lam * v[idx] + (1 - lam) * v_i
+
+        if self.is_complex:
+            y = torch.cat([y, v], dim=1)
+            return X, y
+        else:
+            X_mag = torch.abs(X)
+            y_mag = torch.abs(torch.cat([y, v], dim=1))
+            return X_mag, y_mag
+
+
+def collate_batch_aug(items):
+    # Collates the items of VocalRemoverTrainingSet(batch_aug=True). Mixup
+    # partners are stacked only for the samples that drew one, together with
+    # the indices of those samples, so nothing is sent twice.
+    collate = torch.utils.data.default_collate
+    X, y, v = collate([item[:3] for item in items])
+
+    idx = [i for i, item in enumerate(items) if item[3] is not None]
+    if len(idx) > 0:
+        X_i, y_i, v_i = collate([items[i][3] for i in idx])
+    else:
+        X_i, y_i, v_i = [torch.empty((0,) + X.shape[1:], dtype=X.dtype)] * 3
+
+    return X, y, v, X_i, y_i, v_i, torch.tensor(idx, dtype=torch.long)
+
+
+class VocalRemoverValidationSet(torch.utils.data.Dataset):
+
+    def __init__(self, validation_set, is_complex=False):
+        self.validation_set = validation_set
+        self.is_complex = is_complex
+        self.index = load_validation_index(validation_set)
+        self._store = None
+
+    def __len__(self):
+        return self.index['n_patch']
+
+    def __getstate__(self):
+        # DataLoader workers map the store themselves
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
+
+    def open_store(self):
+        if self._store is None:
+            self._store = [
+                np.load(os.path.join(self.validation_set, name + '.npy'), mmap_mode='r')
+                for name in ['X', 'y', 'v']
+            ]
+
+        return self._store
+
+    def __getitem__(self, idx):
+        X, y, v = [np.array(store[idx]) for store in self.open_store()]
+
+        if self.is_complex:
+            y = np.concatenate([y, v])
+            return X, y
+        else:
+            X_mag = np.abs(X)
+            y_mag = np.abs(np.concatenate([y, v]))
+            return X_mag, y_mag
+
+
+def make_pair(X_dir, y_dir, v_dir=None):
+    input_exts = ['.wav', '.m4a', '.mp3', '.mp4', '.flac']
+
+    X_list = sorted([
+        os.path.join(X_dir, fname)
+        for fname in os.listdir(X_dir)
+        if os.path.splitext(fname)[1] in input_exts
+    ])
+    y_list = sorted([
+        os.path.join(y_dir, fname)
+        for fname in os.listdir(y_dir)
+        if os.path.splitext(fname)[1] in input_exts
+    ])
+
+    if v_dir is not None:
+        v_list = sorted([
+            os.path.join(v_dir, fname)
+            for fname in os.listdir(v_dir)
+            if os.path.splitext(fname)[1] in input_exts
+        ])
+        filelist = list(zip(X_list, y_list, v_list))
+    else:
+        filelist = list(zip(X_list, y_list))
+
+    return filelist
+
+
+def train_val_split(dataset_dir, split_mode, val_rate, val_filelist=[]):
+    if split_mode == 'random':
+        filelist = make_pair(
+            os.path.join(dataset_dir, 'mixtures'),
+            os.path.join(dataset_dir, 'instruments'),
+            os.path.join(dataset_dir, 'pseudo_vocals')
+        )
+
+        random.shuffle(filelist)
+
+        if len(val_filelist) == 0:
+            val_size = int(len(filelist) * val_rate)
+            train_filelist = filelist[:-val_size]
+            val_filelist = filelist[-val_size:]
+        else:
+            train_filelist = [
+                pair for pair in filelist
+                if list(pair) not in val_filelist
+            ]
+    elif split_mode == 'subdirs':
+        if len(val_filelist) != 0:
+            raise ValueError('`val_filelist` option is not available with `subdirs` mode')
+
+        train_filelist = make_pair(
+            os.path.join(dataset_dir, 'training/mixtures'),
+            os.path.join(dataset_dir, 'training/instruments'),
+            os.path.join(dataset_dir, 'training/pseudo_vocals')
+        )
+
+        val_filelist = make_pair(
+            os.path.join(dataset_dir, 'validation/mixtures'),
+            os.path.join(dataset_dir, 'validation/instruments'),
+            os.path.join(dataset_dir, 'validation/pseudo_vocals')
+        )
+
+    return train_filelist, val_filelist
+
+
+def raw_data_split(dataset_dir, split_mode):
+    if split_mode == 'random':
+        filelist = make_pair(
+            os.path.join(dataset_dir, 'mixtures'),
+            os.path.join(dataset_dir, 'instruments'),
+        )
+    elif split_mode == 'subdirs':
+        train_filelist = make_pair(
+            os.path.join(dataset_dir, 'training/mixtures'),
+            os.path.join(dataset_dir, 'training/instruments'),
+        )
+        val_filelist = make_pair(
+            os.path.join(dataset_dir, 'validation/mixtures'),
+            os.path.join(dataset_dir, 'validation/instruments'),
+        )
+        filelist = train_filelist + val_filelist
+
+    return filelist
+
+
+def make_padding(width, cropsize, offset):
+    left = offset
+    roi_size = cropsize - offset * 2
+    if roi_size == 0:
+        roi_size = cropsize
+    right = roi_size - (width % roi_size) + left
+
+    return left, right, roi_size
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def describe_cache(cache_path):
+    st = os.stat(cache_path)
+    spec = np.load(cache_path, mmap_mode='r')
+
+    return {
+        'shape': list(spec.shape),
+        'dtype': spec.dtype.str,
+        'peak': float(np.abs(spec).max()),
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns
+    }
+
+
+def is_valid_entry(entry, cache_path):
+    if entry is None or not os.path.exists(cache_path):
+        return False
+
+    st = os.stat(cache_path)
+    return entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+
+def build_cache(X_path, y_path, v_path, sr, hop_length, n_fft):
+    # computes the caches that are missing and describes all three of them
+    cache_paths = spec_utils.get_cache_paths(X_path, y_path, v_path, sr, hop_length, n_fft)
+    if not all(os.path.exists(cache_path) for cache_path in cache_paths):
+        spec_utils.cache_or_load(X_path, y_path, v_path, sr, hop_length, n_fft)
+
+    return [describe_cache(cache_path) for cache_path in cache_paths]
+
+
+def make_training_set(filelist, sr, hop_length, n_fft, num_workers=0):
+    # Shape, dtype and peak of every cache file are recorded in a manifest
+    # next to the caches, so only new or modified files are ever read here.
+    entries = []
+    manifests = {}
+    missing = []
+    for i, (X_path, y_path, v_path) in enumerate(filelist):
+        cache_paths = spec_utils.get_cache_paths(X_path, y_path, v_path, sr, hop_length, n_fft)
+        entry = []
+        for cache_path in cache_paths:
+            cache_dir, name = os.path.split(cache_path)
+            if cache_dir not in manifests:
+                manifests[cache_dir] = load_manifest(cache_dir)
+            entry.append(manifests[cache_dir].get(name))
+
+        if not all(is_valid_entry(e, c) for e, c in zip(entry, cache_paths)):
+            missing.append(i)
+        entries.append((cache_paths, entry))
+
+    def update(i, entry):
+        cache_paths, _ = entries[i]
+        entries[i] = cache_paths, entry
+        for cache_path, e in zip(cache_paths, entry):
+            cache_dir, name = os.path.split(cache_path)
+            manifests.setdefault(cache_dir, {})[name] = e
+
+    if len(missing) > 0:
+        if num_workers > 0:
+            # spawned, not forked from a process that runs torch's thread pools
+            ctx = multiprocessing.get_context('spawn')
+            with futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx) as executor:
+                jobs = [
+                    executor.submit(build_cache, *filelist[i], sr, hop_length, n_fft)
+                    for i in missing
+                ]
+                for i, job in tqdm(zip(missing, jobs), total=len(missing)):
+                    update(i, job.result())
+        else:
+            for i in tqdm(missing):
+                update(i, build_cache(*filelist[i], sr, hop_length, n_fft))
+
+        for cache_dir, manifest in manifests.items():
+            save_manifest(cache_dir, manifest)
+
+    ret = []
+    for cache_paths, entry in entries:
+        coef = max(e['peak'] for e in entry)
+        ret.append(cache_paths + [coef])
+
+    return ret
+
+
+VALIDATION_INDEX_NAME = 'index.json'
+
+
+def load_validation_index(patch_dir):
+    with open(os.path.join(patch_dir, VALIDATION_INDEX_NAME), 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def fill_validation_patches(patch_dir, cache_paths, coef, first, cropsize, offset):
+    specs = [np.load(cache_path).transpose(1, 2, 0) / coef for cache_path in cache_paths]
+    stores = [
+        np.load(os.path.join(patch_dir, name + '.npy'), mmap_mode='r+')
+        for name in ['X', 'y', 'v']
+    ]
+
+    n_frame = specs[0].shape[2]
+    l, r, roi_size = make_padding(n_frame, cropsize, offset)
+    len_dataset = int(np.ceil(n_frame / roi_size))
+    for spec, store in zip(specs, stores):
+        spec_pad = np.pad(spec, ((0, 0), (0, 0), (l, r)), mode='constant')
+        for j in range(len_dataset):
+            start = j * roi_size
+            store[first + j] = spec_pad[:, :, start:start + cropsize]
+        store.flush()
+
+
+def make_validation_set(filelist, cropsize, sr, hop_length, n_fft, offset, num_workers=0):
+    # All patches live in one memory-mapped array per source (X.npy, y.npy,
+    # v.npy) under `patch_dir`. index.json is written last and records what
+    # the store was built from, the size and mtime of every cache included,
+    # so the store is reused only while none of them has changed. Stale caches
+    # are rebuilt by make_training_set first and so change the fingerprint.
+    patch_dir = 'cs{}_sr{}_hl{}_nf{}_of{}'.format(cropsize, sr, hop_length, n_fft, offset)
+    files = [list(pair) for pair in filelist]
+    entries = make_training_set(filelist, sr, hop_length, n_fft, num_workers)
+    caches = []
+    for entry in entries:
+        for cache_path in entry[:3]:
+            st = os.stat(cache_path)
+            caches.append([st.st_size, st.st_mtime_ns])
+
+    index_path = os.path.join(patch_dir, VALIDATION_INDEX_NAME)
+    if os.path.exists(index_path):
+        index = load_validation_index(patch_dir)
+        if index['files'] == files and index.get('caches') == caches:
+            return patch_dir
+
+    os.makedirs(patch_dir, exist_ok=True)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    patches = []
+    firsts = []
+    for (X_path, _, _), (X_cache_path, _, _, _) in zip(filelist, entries):
+        basename = os.path.splitext(os.path.basename(X_path))[0]
+        X = np.load(X_cache_path, mmap_mode='r')
+        _, _, roi_size = make_padding(X.shape[0], cropsize, offset)
+        firsts.append(len(patches))
+        patches += [[basename, j] for j in range(int(np.ceil(X.shape[0] / roi_size)))]
+
+    shape = (len(patches),) + X.shape[1:] + (cropsize,)
+    for name in ['X', 'y', 'v']:
+        store = np.lib.format.open_memmap(
+            os.path.join(patch_dir, name + '.npy'), mode='w+', dtype=X.dtype, shape=shape
+        )
+        del store
+
+    args = [
+        (patch_dir, entry[:3], entry[3], first, cropsize, offset)
+        for entry, first in zip(entries, firsts)
+    ]
+    if num_workers > 0:
+        ctx = multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx) as executor:
+            jobs = [executor.submit(fill_validation_patches, *a) for a in args]
+            for job in tqdm(jobs):
+                job.result()
+    else:
+        for a in tqdm(args):
+            fill_validation_patches(*a)
+
+    index = {
+        'files': files,
+        'caches': caches,
+        'n_patch': len(patches),
+        'patches': patches
+    }
+    with open(index_path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+    return patch_dir
+
+
+if __name__ == "__main__":
+    import sys
+    import utils
+
+    mix_dir = sys.argv[1]
+    inst_dir = sys.argv[2]
+    outdir = sys.argv[3]
+
+    os.makedirs(outdir, exist_ok=True)
+
+    filelist = make_pair(mix_dir, inst_dir)
+    for mix_path, inst_path in tqdm(filelist):
+        mix_basename = os.path.splitext(os.path.basename(mix_path))[0]
+
+        X_spec, y_spec, _, _ = spec_utils.cache_or_load(
+            mix_path, inst_path, 44100, 1024, 2048
+        )
+
+        X_mag = np.abs(X_spec)
+        y_mag = np.abs(y_spec)
+        v_mag = X_mag - y_mag
+        v_mag *= v_mag > y_mag
+
+        outpath = '{}/{}_Vocal.jpg'.format(outdir, mix_basename)
+        v_image = spec_utils.spectrogram_to_image(v_mag)
+        utils.imwrite(outpath, v_image)
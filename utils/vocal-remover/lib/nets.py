@@ -1,140 +1,216 @@
-import torch
-from torch import nn
-import torch.nn.functional as F
-
-from lib import layers
-
-
-class BaseNet(nn.Module):
-
-    def __init__(self, nin, nout, nin_lstm, nout_lstm, dilations=((4, 2), (8, 4), (12, 6))):
-        super(BaseNet, self).__init__()
-        self.enc1 = layers.Conv2DBNActiv(nin, nout, 3, 1, 1)
-        self.enc2 = layers.Encoder(nout, nout * 2, 3, 2, 1)
-        self.enc3 = layers.Encoder(nout * 2, nout * 4, 3, 2, 1)
-        self.enc4 = layers.Encoder(nout * 4, nout * 6, 3, 2, 1)
-        self.enc5 = layers.Encoder(nout * 6, nout * 8, 3, 2, 1)
-
-        self.aspp = layers.ASPPModule(nout * 8, nout * 8, dilations, dropout=True)
-
-        self.dec4 = layers.Decoder(nout * (6 + 8), nout * 6, 3, 1, 1)
-        self.dec3 = layers.Decoder(nout * (4 + 6), nout * 4, 3, 1, 1)
-        self.dec2 = layers.Decoder(nout * (2 + 4), nout * 2, 3, 1, 1)
-        self.lstm_dec2 = layers.LSTMModule(nout * 2, nin_lstm, nout_lstm)
-        self.dec1 = layers.Decoder(nout * (1 + 2) + 1, nout * 1, 3, 1, 1)
-
-    def __call__(self, x):
-        e1 = self.enc1(x)
-        e2 = self.enc2(e1)
-        e3 = self.enc3(e2)
-        e4 = self.enc4(e3)
-        e5 = self.enc5(e4)
-
-        h = self.aspp(e5)
-
-        h = self.dec4(h, e4)
-        h = self.dec3(h, e3)
-        h = self.dec2(h, e2)
-        h = torch.cat([h, self.lstm_dec2(h)], dim=1)
-        h = self.dec1(h, e1)
-
-        return h
-
-
-class CascadedNet(nn.Module):
-
-    def __init__(self, n_fft, hop_length, nout=32, nout_lstm=128, is_complex=False):
-        super(CascadedNet, self).__init__()
-        self.n_fft = n_fft
-        self.hop_length = hop_length
-        self.is_complex = is_complex
-
-        self.max_bin = n_fft // 2
-        self.output_bin = n_fft // 2 + 1
-        self.nin_lstm = self.max_bin // 2
-        self.offset = 64
-
-        self.nin = 4 if is_complex else 2
-
-        self.stg1_low_band_net = nn.Sequential(
-            BaseNet(self.nin, nout // 2, self.nin_lstm // 2, nout_lstm),
-            layers.Conv2DBNActiv(nout // 2, nout // 4, 1, 1, 0)
-        )
-        self.stg1_high_band_net = BaseNet(
-            self.nin, nout // 4, self.nin_lstm // 2, nout_lstm // 2
-        )
-
-        self.stg2_low_band_net = nn.Sequential(
-            BaseNet(nout // 4 + self.nin, nout, self.nin_lstm // 2, nout_lstm),
-            layers.Conv2DBNActiv(nout, nout // 2, 1, 1, 0)
-        )
-        self.stg2_high_band_net = BaseNet(
-            nout // 4 + self.nin, nout // 2, self.nin_lstm // 2, nout_lstm // 2
-        )
-
-        self.stg3_full_band_net = BaseNet(
-            3 * nout // 4 + self.nin, nout, self.nin_lstm, nout_lstm
-        )
-
-        self.out = nn.Conv2d(nout, self.nin * 2, 1, bias=False)
-
-    def forward(self, x):
-        if self.is_complex:
-            x = torch.cat([x.real, x.imag], dim=1)
-
-        x = x[:, :, :self.max_bin]
-
-        bandw = x.size()[2] // 2
-        l1_in = x[:, :, :bandw]
-        h1_in = x[:, :, bandw:]
-        l1 = self.stg1_low_band_net(l1_in)
-        h1 = self.stg1_high_band_net(h1_in)
-        aux1 = torch.cat([l1, h1], dim=2)
-
-        l2_in = torch.cat([l1_in, l1], dim=1)
-        h2_in = torch.cat([h1_in, h1], dim=1)
-        l2 = self.stg2_low_band_net(l2_in)
-        h2 = self.stg2_high_band_net(h2_in)
-        aux2 = torch.cat([l2, h2], dim=2)
-
-        f3_in = torch.cat([x, aux1, aux2], dim=1)
-        f3 = self.stg3_full_band_net(f3_in)
-
-        if self.is_complex:
-            mask = self.out(f3)
-            mask = torch.complex(mask[:, :self.nin], mask[:, self.nin:])
-            mask = self.bounded_mask(mask)
-        else:
-            mask = torch.sigmoid(self.out(f3))
-
-        mask = F.pad(
-            input=mask,
-            pad=(0, 0, 0, self.output_bin - mask.size()[2]),
-            mode='replicate'
-        )
-
-        return mask
-
-    def bounded_mask(self, mask, eps=1e-8):
-        mask_mag = torch.abs(mask)
-        mask = torch.tanh(mask_mag) * mask / (mask_mag + eps)
-        return mask
-
-    def predict_mask(self, x):
-        mask = self.forward(x)
-
-        if self.offset > 0:
-            mask = mask[:, :, :, self.offset:-self.offset]
-            assert mask.size()[3] > 0
-
-        return mask
-
-    def predict(self, x):
-        mask = self.forward(x)
-        pred = torch.cat([x, x], dim=1) * mask
-
-        if self.offset > 0:
-            pred = pred[:, :, :, self.offset:-self.offset]
-            assert pred.size()[3] > 0
-
-        return pred
+import json
+import warnings
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from lib import layers
+
+
+class BaseNet(nn.Module):
+
+    def __init__(self, nin, nout, nin_lstm, nout_lstm, dilations=((4, 2), (8, 4), (12, 6))):
+        super(BaseNet, self).__init__()
+        self.enc1 = layers.Conv2DBNActiv(nin, nout, 3, 1, 1)
+        self.enc2 = layers.Encoder(nout, nout * 2, 3, 2, 1)
+        self.enc3 = layers.Encoder(nout * 2, nout * 4, 3, 2, 1)
+        self.enc4 = layers.Encoder(nout * 4, nout * 6, 3, 2, 1)
+        self.enc5 = layers.Encoder(nout * 6, nout * 8, 3, 2, 1)
+
+        self.aspp = layers.ASPPModule(nout * 8, nout * 8, dilations, dropout=True)
+
+        self.dec4 = layers.Decoder(nout * (6 + 8), nout * 6, 3, 1, 1)
+        self.dec3 = layers.Decoder(nout * (4 + 6), nout * 4, 3, 1, 1)
+        self.dec2 = layers.Decoder(nout * (2 + 4), nout * 2, 3, 1, 1)
+        self.lstm_dec2 = layers.LSTMModule(nout * 2, nin_lstm, nout_lstm)
+        self.dec1 = layers.Decoder(nout * (1 + 2) + 1, nout * 1, 3, 1, 1)
+
+    def __call__(self, x):
+        e1 = self.enc1(x)
+        e2 = self.enc2(e1)
+        e3 = self.enc3(e2)
+        e4 = self.enc4(e3)
+        e5 = self.enc5(e4)
+
+        h = self.aspp(e5)
+
+        h = self.dec4(h, e4)
+        h = self.dec3(h, e3)
+        h = self.dec2(h, e2)
+        h = torch.cat([h, self.lstm_dec2(h)], dim=1)
+        h = self.dec1(h, e1)
+
+        return h
+
+
+class CascadedNet(nn.Module):
+
+    def __init__(self, n_fft, hop_length, nout=32, nout_lstm=128, is_complex=False):
+        super(CascadedNet, self).__init__()
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.is_complex = is_complex
+
+        self.max_bin = n_fft // 2
+        self.output_bin = n_fft // 2 + 1
+        self.nin_lstm = self.max_bin // 2
+        self.offset = 64
+
+        self.nin = 4 if is_complex else 2
+
+        self.stg1_low_band_net = nn.Sequential(
+            BaseNet(self.nin, nout // 2, self.nin_lstm // 2, nout_lstm),
+            layers.Conv2DBNActiv(nout // 2, nout // 4, 1, 1, 0)
+        )
+        self.stg1_high_band_net = BaseNet(
+            self.nin, nout // 4, self.nin_lstm // 2, nout_lstm // 2
+        )
+
+        self.stg2_low_band_net = nn.Sequential(
+            BaseNet(nout // 4 + self.nin, nout, self.nin_lstm // 2, nout_lstm),
+            layers.Conv2DBNActiv(nout, nout // 2, 1, 1, 0)
+        )
+        self.stg2_high_band_net = BaseNet(
+            nout // 4 + self.nin, nout // 2, self.nin_lstm // 2, nout_lstm // 2
+        )
+
+        self.stg3_full_band_net = BaseNet(
+            3 * nout // 4 + self.nin, nout, self.nin_lstm, nout_lstm
+        )
+
+        self.out = nn.Conv2d(nout, self.nin * 2, 1, bias=False)
+
+    def forward(self, x):
+        if self.is_complex:
+            x = torch.cat([x.real, x.imag], dim=1)
+
+        x = x[:, :, :self.max_bin]
+
+        bandw = x.size()[2] // 2
+        l1_in = x[:, :, :bandw]
+        h1_in = x[:, :, bandw:]
+        l1 = self.stg1_low_band_net(l1_in)
+        h1 = self.stg1_high_band_net(h1_in)
+        aux1 = torch.cat([l1, h1], dim=2)
+
+        l2_in = torch.cat([l1_in, l1], dim=1)
+        h2_in = torch.cat([h1_in, h1], dim=1)
+        l2 = self.stg2_low_band_net(l2_in)
+        h2 = self.stg2_high_band_net(h2_in)
+        aux2 = torch.cat([l2, h2], dim=2)
+
+        f3_in = torch.cat([x, aux1, aux2], dim=1)
+        f3 = self.stg3_full_band_net(f3_in)
+
+        # the output projection and the mask nonlinearity are kept in fp32
+        # when the body runs under autocast
+        with torch.autocast('cuda' if f3.is_cuda else 'cpu', enabled=False):
+            f3 = f3.float()
+
+            if self.is_complex:
+                mask = self.out(f3)
+                mask = torch.complex(mask[:, :self.nin], mask[:, self.nin:])
+                mask = self.bounded_mask(mask)
+            else:
+                mask = torch.sigmoid(self.out(f3))
+
+            mask = F.pad(
+                input=mask,
+                pad=(0, 0, 0, self.output_bin - mask.size()[2]),
+                mode='replicate'
+            )
+
+        return mask
+
+    def bounded_mask(self, mask, eps=1e-8):
+        mask_mag = torch.abs(mask)
+        mask = torch.tanh(mask_mag) * mask / (mask_mag + eps)
+        return mask
+
+    def predict_mask(self, x):
+        mask = self.forward(x)
+
+        if self.offset > 0:
+            mask = mask[:, :, :, self.offset:-self.offset]
+            assert mask.size()[3] > 0
+
+        return mask
+
+    def predict(self, x):
+        mask = self.forward(x)
+        pred = torch.cat([x, x], dim=1) * mask
+
+        if self.offset > 0:
+            pred = pred[:, :, :, self.offset:-self.offset]
+            assert pred.size()[3] > 0
+
+        return pred
+
+    def fuse(self):
+        self.eval()
+        for module in list(self.modules()):
+            if isinstance(module, (layers.Conv2DBNActiv, layers.LSTMModule)):
+                module.fuse()
+
+        return self
+
+
+class MaskPredictor(nn.Module):
+
+    def __init__(self, model):
+        super(MaskPredictor, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.predict_mask(x)
+
+
+class ExportedNet(nn.Module):
+
+    def __init__(self, module, n_fft, hop_length, is_complex, offset, cropsize):
+        super(ExportedNet, self).__init__()
+        self.module = module
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.is_complex = is_complex
+        self.offset = offset
+        self.cropsize = cropsize
+
+    def predict_mask(self, x):
+        if x.size()[3] != self.cropsize:
+            raise ValueError('the model was exported for cropsize {}'.format(self.cropsize))
+
+        return self.module(x)
+
+
+def export_model(model, path, cropsize=256):
+    # BatchNorm is folded into the preceding layers and the mask predictor is
+    # traced and frozen into a TorchScript artifact
+    model = model.cpu().fuse()
+    dtype = torch.complex64 if model.is_complex else torch.float32
+    x = torch.zeros(1, 2, model.output_bin, cropsize, dtype=dtype)
+
+    with torch.no_grad(), warnings.catch_warnings():
+        # the crop width is baked into the trace; ExportedNet checks it on use
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        module = torch.jit.trace(MaskPredictor(model), x)
+        module = torch.jit.freeze(module.eval())
+
+    config = {
+        'n_fft': model.n_fft,
+        'hop_length': model.hop_length,
+        'is_complex': model.is_complex,
+        'offset': model.offset,
+        'cropsize': cropsize
+    }
+    torch.jit.save(module, path, _extra_files={'config.json': json.dumps(config)})
+
+
+def load_exported_model(path, device=None):
+    extra_files = {'config.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    config = json.loads(extra_files['config.json'])
+
+    return ExportedNet(module, **config)
+
@@ -1,163 +1,287 @@
-import os
-
-import librosa
-import numpy as np
-import soundfile as sf
-
-
-def crop_center(h1, h2):
-    h1_shape = h1.size()
-    h2_shape = h2.size()
-
-    if h1_shape[3] == h2_shape[3]:
-        return h1
-    elif h1_shape[3] < h2_shape[3]:
-        raise ValueError('h1_shape[3] must be greater than h2_shape[3]')
-
-    # s_freq = (h2_shape[2] - h1_shape[2]) // 2
-    # e_freq = s_freq + h1_shape[2]
-    s_time = (h1_shape[3] - h2_shape[3]) // 2
-    e_time = s_time + h2_shape[3]
-    h1 = h1[:, :, :, s_time:e_time]
-
-    return h1
-
-
-def wave_to_spectrogram(wave, hop_length, n_fft):
-    spec_left = librosa.stft(wave[0], n_fft=n_fft, hop_length=hop_length)
-    spec_right = librosa.stft(wave[1], n_fft=n_fft, hop_length=hop_length)
-    spec = np.asarray([spec_left, spec_right])
-
-    return spec
-
-
-def spectrogram_to_image(spec, mode='magnitude'):
-    if mode == 'magnitude':
-        if np.iscomplexobj(spec):
-            y = np.abs(spec)
-        else:
-            y = spec
-        y = np.log10(y ** 2 + 1e-8)
-    elif mode == 'phase':
-        if np.iscomplexobj(spec):
-            y = np.angle(spec)
-        else:
-            y = spec
-
-    y -= y.min()
-    y *= 255 / y.max()
-    img = np.uint8(y)
-
-    if y.ndim == 3:
-        img = img.transpose(1, 2, 0)
-        img = np.concatenate([
-            np.max(img, axis=2, keepdims=True), img
-        ], axis=2)
-
-    return img
-
-
-def get_reduction_weight(n_fft, sr, reduction_level):
-    bins = n_fft // 2 + 1
-    freq_to_bin = 2 * bins / sr
-    unstable_bins = int(200 * freq_to_bin)
-    stable_bins = int(22050 * freq_to_bin)
-    return np.concatenate([
-        np.linspace(0, 1, unstable_bins + 1, dtype=np.float32)[:unstable_bins, None],
-        np.linspace(1, 0, stable_bins - unstable_bins, dtype=np.float32)[:, None],
-        np.zeros((bins - stable_bins, 1), dtype=np.float32),
-    ], axis=0) * reduction_level
-
-
-def align_wave_head_and_tail(a, b, sr):
-    a, _ = librosa.effects.trim(a)
-    b, _ = librosa.effects.trim(b)
-
-    a_mono = a[:, :sr * 4].sum(axis=0)
-    b_mono = b[:, :sr * 4].sum(axis=0)
-
-    a_mono -= a_mono.mean()
-    b_mono -= b_mono.mean()
-
-    offset = len(a_mono) - 1
-    delay = np.argmax(np.correlate(a_mono, b_mono, 'full')) - offset
-
-    if delay > 0:
-        a = a[:, delay:]
-    else:
-        b = b[:, np.abs(delay):]
-
-    if a.shape[1] < b.shape[1]:
-        b = b[:, :a.shape[1]]
-    else:
-        a = a[:, :b.shape[1]]
-
-    return a, b
-
-
-def cache_or_load(X_path, y_path, v_path, sr, hop_length, n_fft):
-    X_basename = os.path.splitext(os.path.basename(X_path))[0]
-    y_basename = os.path.splitext(os.path.basename(y_path))[0]
-    v_basename = os.path.splitext(os.path.basename(v_path))[0]
-
-    cache_dir = 'sr{}_hl{}_nf{}'.format(sr, hop_length, n_fft)
-    X_cache_dir = os.path.join(os.path.dirname(X_path), cache_dir)
-    y_cache_dir = os.path.join(os.path.dirname(y_path), cache_dir)
-    v_cache_dir = os.path.join(os.path.dirname(v_path), cache_dir)
-
-    X_cache_path = os.path.join(X_cache_dir, X_basename + '.npy')
-    y_cache_path = os.path.join(y_cache_dir, y_basename + '.npy')
-    v_cache_path = os.path.join(v_cache_dir, v_basename + '.npy')
-
-    if os.path.exists(X_cache_path) and os.path.exists(y_cache_path) and os.path.exists(v_cache_path):
-        X = np.load(X_cache_path).transpose(1, 2, 0)
-        y = np.load(y_cache_path).transpose(1, 2, 0)
-        v = np.load(v_cache_path).transpose(1, 2, 0)
-
-    assert X.shape == y.shape == v.shape
-
-    return X, y, v, X_cache_path, y_cache_path, v_cache_path
-
-
-def spectrogram_to_wave(spec, hop_length=1024):
-    if spec.ndim == 2:
-        wave = librosa.istft(spec, hop_length=hop_length)
-    elif spec.ndim == 3:
-        wave_left = librosa.istft(spec[0], hop_length=hop_length)
-        wave_right = librosa.istft(spec[1], hop_length=hop_length)
-        wave = np.asarray([wave_left, wave_right])
-
-    return wave
-
-
-if __name__ == "__main__":
-    import cv2
-    import sys
-
-    X, _ = librosa.load(
-        sys.argv[1], sr=44100, mono=False, dtype=np.float32, res_type='kaiser_fast'
-    )
-    y, _ = librosa.load(
-        sys.argv[2], sr=44100, mono=False, dtype=np.float32, res_type='kaiser_fast'
-    )
-
-    X, y = align_wave_head_and_tail(X, y, 44100)
-    X_spec = wave_to_spectrogram(X, 1024, 2048)
-    y_spec = wave_to_spectrogram(y, 1024, 2048)
-
-    # X_spec = np.load(sys.argv[1]).transpose(1, 2, 0)
-    # y_spec = np.load(sys.argv[2]).transpose(1, 2, 0)
-
-    v_spec = X_spec - y_spec
-
-    X_image = spectrogram_to_image(X_spec)
-    y_image = spectrogram_to_image(y_spec)
-    v_image = spectrogram_to_image(v_spec)
-
-    cv2.imwrite('test_X.jpg', X_image)
-    cv2.imwrite('test_y.jpg', y_image)
-    cv2.imwrite('test_v.jpg', v_image)
-
-    sf.write('test_X.wav', spectrogram_to_wave(X_spec).T, 44100)
-    sf.write('test_y.wav', spectrogram_to_wave(y_spec).T, 44100)
-    sf.write('test_v.wav', spectrogram_to_wave(v_spec).T, 44100)
+import functools
+import os
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+try:
+    from lib import audio
+except ModuleNotFoundError:
+    import audio
+
+
+def crop_center(h1, h2):
+    h1_shape = h1.size()
+    h2_shape = h2.size()
+
+    if h1_shape[3] == h2_shape[3]:
+        return h1
+    elif h1_shape[3] < h2_shape[3]:
+        raise ValueError('h1_shape[3] must be greater than h2_shape[3]')
+
+    # s_freq = (h2_shape[2] - h1_shape[2]) // 2
+    # e_freq = s_freq + h1_shape[2]
+    s_time = (h1_shape[3] - h2_shape[3]) // 2
+    e_time = s_time + h2_shape[3]
+    h1 = h1[:, :, :, s_time:e_time]
+
+    return h1
+
+
+class STFT(object):
+
+    def __init__(self, n_fft, hop_length, device=None):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.device = device
+        self.window = torch.hann_window(n_fft, device=device)
+
+    def wave_to_spectrogram(self, wave):
+        # (..., n_sample) -> (..., n_bin, n_frame); every leading axis
+        # (channels, stems, songs) goes through a single batched call.
+        shape = wave.shape[:-1]
+        wave = np.ascontiguousarray(wave, dtype=np.float32).reshape(-1, wave.shape[-1])
+        wave = torch.from_numpy(wave).to(self.device)
+
+        # constant padding matches librosa.stft
+        spec = torch.stft(
+            wave, self.n_fft, self.hop_length,
+            window=self.window,
+            center=True,
+            pad_mode='constant',
+            return_complex=True
+        )
+
+        return spec.reshape(shape + spec.shape[-2:]).cpu().numpy()
+
+    def spectrogram_to_wave(self, spec, length=None):
+        # (..., n_bin, n_frame) -> (..., n_sample)
+        shape = spec.shape[:-2]
+        spec = np.ascontiguousarray(spec, dtype=np.complex64).reshape((-1,) + spec.shape[-2:])
+        spec = torch.from_numpy(spec).to(self.device)
+
+        wave = torch.istft(
+            spec, self.n_fft, self.hop_length,
+            window=self.window,
+            center=True,
+            length=length
+        )
+
+        return wave.reshape(shape + wave.shape[-1:]).cpu().numpy()
+
+
+@functools.lru_cache(maxsize=None)
+def get_stft(n_fft, hop_length):
+    return STFT(n_fft, hop_length)
+
+
+def wave_to_spectrogram(wave, hop_length, n_fft):
+    return get_stft(n_fft, hop_length).wave_to_spectrogram(wave)
+
+
+def spectrogram_to_image(spec, mode='magnitude'):
+    if mode == 'magnitude':
+        if np.iscomplexobj(spec):
+            y = np.abs(spec)
+        else:
+            y = spec
+        y = np.log10(y ** 2 + 1e-8)
+    elif mode == 'phase':
+        if np.iscomplexobj(spec):
+            y = np.angle(spec)
+        else:
+            y = spec
+
+    y -= y.min()
+    y *= 255 / y.max()
+    img = np.uint8(y)
+
+    if y.ndim == 3:
+        img = img.transpose(1, 2, 0)
+        img = np.concatenate([
+            np.max(img, axis=2, keepdims=True), img
+        ], axis=2)
+
+    return img
+
+
+def get_reduction_weight(n_fft, sr, reduction_level):
+    bins = n_fft // 2 + 1
+    freq_to_bin = 2 * bins / sr
+    unstable_bins = int(200 * freq_to_bin)
+    stable_bins = int(22050 * freq_to_bin)
+    return np.concatenate([
+        np.linspace(0, 1, unstable_bins + 1, dtype=np.float32)[:unstable_bins, None],
+        np.linspace(1, 0, stable_bins - unstable_bins, dtype=np.float32)[:, None],
+        np.zeros((bins - stable_bins, 1), dtype=np.float32),
+    ], axis=0) * reduction_level
+
+
+def correlate(a, b):
+    # np.correlate(a, b, 'full') computed through the FFT in O(n log n)
+    n = len(a) + len(b) - 1
+    n_fft = 1 << (n - 1).bit_length()
+    spec = np.fft.rfft(a, n_fft) * np.fft.rfft(b[::-1], n_fft)
+
+    return np.fft.irfft(spec, n_fft)[:n]
+
+
+def _correlate_at(a, b, k):
+    # the k-th value of np.correlate(a, b, 'full'), computed directly
+    shift = k - (len(b) - 1)
+    if shift >= 0:
+        m = min(len(a) - shift, len(b))
+        return np.dot(a[shift:shift + m], b[:m])
+
+    m = min(len(a), len(b) + shift)
+    return np.dot(a[:m], b[-shift:-shift + m])
+
+
+def argmax_correlation(a, b, max_lag=None, factor=16):
+    # Index of the maximum of np.correlate(a, b, 'full'). Every FFT value
+    # within rounding distance of the peak is recomputed directly, so the
+    # rounding cannot change which index wins.
+    #
+    # With `max_lag` only shifts of up to max_lag samples are searched:
+    # first on both signals summed over blocks of `factor` samples, then
+    # directly within two blocks around the coarse peak. This is much
+    # cheaper, but exact only when the coarse peak is the right one.
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    n = len(a) + len(b) - 1
+
+    if max_lag is None:
+        corr = correlate(a, b)
+        scale = np.sqrt(np.dot(a, a) * np.dot(b, b))
+        if scale == 0:
+            # silence; np.correlate returns all zeros
+            return 0
+        candidates = np.flatnonzero(corr >= corr.max() - 1e-9 * scale)
+    else:
+        a_c = a[:len(a) // factor * factor].reshape(-1, factor).sum(axis=1)
+        b_c = b[:len(b) // factor * factor].reshape(-1, factor).sum(axis=1)
+        corr = correlate(a_c, b_c)
+        shifts = np.arange(len(corr)) - (len(b_c) - 1)
+        corr[np.abs(shifts) > max_lag // factor + 1] = -np.inf
+        shift = shifts[np.argmax(corr)] * factor
+
+        candidates = np.arange(shift - 2 * factor, shift + 2 * factor + 1)
+        candidates = candidates[np.abs(candidates) <= max_lag] + len(b) - 1
+        candidates = candidates[(candidates >= 0) & (candidates < n)]
+
+    values = [_correlate_at(a, b, k) for k in candidates]
+
+    # the first of equal maxima, as np.argmax
+    return candidates[np.argmax(values)]
+
+
+def align_wave_head_and_tail(a, b, sr, max_lag=None):
+    a, _ = librosa.effects.trim(a)
+    b, _ = librosa.effects.trim(b)
+
+    a_mono = a[:, :sr * 4].sum(axis=0)
+    b_mono = b[:, :sr * 4].sum(axis=0)
+
+    a_mono -= a_mono.mean()
+    b_mono -= b_mono.mean()
+
+    offset = len(a_mono) - 1
+    delay = argmax_correlation(a_mono, b_mono, max_lag) - offset
+
+    if delay > 0:
+        a = a[:, delay:]
+    else:
+        b = b[:, np.abs(delay):]
+
+    if a.shape[1] < b.shape[1]:
+        b = b[:, :a.shape[1]]
+    else:
+        a = a[:, :b.shape[1]]
+
+    return a, b
+
+
+def get_cache_paths(X_path, y_path, v_path, sr, hop_length, n_fft):
+    cache_dir = 'sr{}_hl{}_nf{}'.format(sr, hop_length, n_fft)
+
+    cache_paths = []
+    for path in [X_path, y_path, v_path]:
+        basename = os.path.splitext(os.path.basename(path))[0]
+        cache_paths.append(os.path.join(os.path.dirname(path), cache_dir, basename + '.npy'))
+
+    return cache_paths
+
+
+def cache_or_load(X_path, y_path, v_path, sr, hop_length, n_fft):
+    X_cache_path, y_cache_path, v_cache_path = get_cache_paths(
+        X_path, y_path, v_path, sr, hop_length, n_fft
+    )
+
+    if os.path.exists(X_cache_path) and os.path.exists(y_cache_path) and os.path.exists(v_cache_path):
+        X = np.load(X_cache_path).transpose(1, 2, 0)
+        y = np.load(y_cache_path).transpose(1, 2, 0)
+        v = np.load(v_cache_path).transpose(1, 2, 0)
+    else:
+        waves = []
+        for path in [X_path, y_path, v_path]:
+            wave, _ = audio.load(path, sr, cache=False)
+            if wave.ndim == 1:
+                # mono to stereo
+                wave = np.asarray([wave, wave])
+            waves.append(wave)
+
+        # only the mixture and instruments are aligned; the pseudo vocals are
+        # read from v_path as they are and cut to the common length
+        X, y = align_wave_head_and_tail(waves[0], waves[1], sr)
+        n_sample = min(X.shape[1], waves[2].shape[1])
+        X, y, v = wave_to_spectrogram(
+            np.asarray([X[:, :n_sample], y[:, :n_sample], waves[2][:, :n_sample]]), hop_length, n_fft
+        )
+
+        for spec, cache_path in zip([X, y, v], [X_cache_path, y_cache_path, v_cache_path]):
+            # written aside and renamed, so an interrupted build leaves no truncated cache
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + '.tmp', 'wb') as f:
+                np.save(f, spec.transpose(2, 0, 1))
+            os.replace(cache_path + '.tmp', cache_path)
+
+    assert X.shape == y.shape == v.shape
+
+    return X, y, v, X_cache_path, y_cache_path, v_cache_path
+
+
+def spectrogram_to_wave(spec, hop_length=1024):
+    n_fft = (spec.shape[-2] - 1) * 2
+
+    return get_stft(n_fft, hop_length).spectrogram_to_wave(spec)
+
+
+if __name__ == "__main__":
+    import cv2
+    import sys
+
+    X, _ = audio.load(sys.argv[1], 44100, cache=False)
+    y, _ = audio.load(sys.argv[2], 44100, cache=False)
+
+    X, y = align_wave_head_and_tail(X, y, 44100)
+    X_spec = wave_to_spectrogram(X, 1024, 2048)
+    y_spec = wave_to_spectrogram(y, 1024, 2048)
+
+    # X_spec = np.load(sys.argv[1]).transpose(1, 2, 0)
+    # y_spec = np.load(sys.argv[2]).transpose(1, 2, 0)
+
+    v_spec = X_spec - y_spec
+
+    X_image = spectrogram_to_image(X_spec)
+    y_image = spectrogram_to_image(y_spec)
+    v_image = spectrogram_to_image(v_spec)
+
+    cv2.imwrite('test_X.jpg', X_image)
+    cv2.imwrite('test_y.jpg', y_image)
+    cv2.imwrite('test_v.jpg', v_image)
+
+    sf.write('test_X.wav', spectrogram_to_wave(X_spec).T, 44100)
+    sf.write('test_y.wav', spectrogram_to_wave(y_spec).T, 44100)
+    sf.write('test_v.wav', spectrogram_to_wave(v_spec).T, 44100)
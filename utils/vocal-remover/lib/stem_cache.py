@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def make_key(waves, **params):
+    # `waves` may be the whole decoded signal or consecutive blocks of it;
+    # the digest only depends on the concatenated samples.
+    h = hashlib.sha256()
+    h.update(json.dumps(params, sort_keys=True).encode())
+    for wave in waves:
+        h.update(wave.astype('<f4', copy=False).T.tobytes())
+
+    return h.hexdigest()
+
+
+class StemCache(object):
+
+    def __init__(self, cache_dir, max_bytes=2 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, output_dir, basename, stems):
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return None
+
+        if output_dir != '':
+            os.makedirs(output_dir, exist_ok=True)
+
+        paths = []
+        try:
+            for stem in stems:
+                path = os.path.join(output_dir, '{}_{}.wav'.format(basename, stem))
+                shutil.copyfile(os.path.join(entry_dir, '{}.wav'.format(stem)), path)
+                paths.append(path)
+            # the directory mtime records the last use for eviction
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            # evicted by another process while copying
+            return None
+
+        return tuple(paths)
+
+    def put(self, key, paths, stems):
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # entries appear atomically, so readers never see a partial one
+        tmp_dir = os.path.join(self.cache_dir, '.{}.{}'.format(key, uuid.uuid4().hex))
+        os.makedirs(tmp_dir)
+        for stem, path in zip(stems, paths):
+            shutil.copyfile(path, os.path.join(tmp_dir, '{}.wav'.format(stem)))
+
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+            except FileNotFoundError:
+                continue
+            total += size
+
+        # least recently used entries go first
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
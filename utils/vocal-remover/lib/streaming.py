@@ -0,0 +1,129 @@
+import numpy as np
+import soundfile as sf
+import soxr
+
+
+def hann_window(n_fft):
+    # periodic Hann window, the one librosa.stft uses by default
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)
+
+
+def read_blocks(path, sr, block_size):
+    with sf.SoundFile(path) as f:
+        resampler = None
+        if f.samplerate != sr:
+            resampler = soxr.ResampleStream(f.samplerate, sr, f.channels, dtype='float32')
+
+        while True:
+            block = f.read(block_size, dtype='float32', always_2d=True)
+            last = len(block) < block_size
+            if resampler is not None:
+                block = resampler.resample_chunk(block, last=last)
+
+            block = block.T
+            if block.shape[0] == 1:
+                # mono to stereo
+                block = np.concatenate([block, block])
+
+            if block.shape[1] > 0:
+                yield block
+
+            if last:
+                break
+
+
+class STFTStream(object):
+
+    def __init__(self, n_fft, hop_length):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.window = hann_window(n_fft)
+        self.buffer = None
+
+    def _frames(self):
+        n_frame = 0
+        if self.buffer.shape[1] >= self.n_fft:
+            n_frame = (self.buffer.shape[1] - self.n_fft) // self.hop_length + 1
+
+        frames = np.lib.stride_tricks.sliding_window_view(self.buffer, self.n_fft, axis=1)
+        frames = frames[:, :n_frame * self.hop_length:self.hop_length]
+        spec = np.fft.rfft(frames * self.window, axis=2).astype(np.complex64)
+        self.buffer = self.buffer[:, n_frame * self.hop_length:]
+
+        return spec.transpose(0, 2, 1)
+
+    def push(self, wave):
+        if self.buffer is None:
+            # centered frames, zero padded as in librosa.stft
+            self.buffer = np.zeros((wave.shape[0], self.n_fft // 2), dtype=np.float32)
+        self.buffer = np.concatenate([self.buffer, wave], axis=1)
+
+        return self._frames()
+
+    def flush(self):
+        if self.buffer is None:
+            # nothing was pushed
+            return np.zeros((0, self.n_fft // 2 + 1, 0), dtype=np.complex64)
+
+        pad = np.zeros((self.buffer.shape[0], self.n_fft // 2), dtype=np.float32)
+        self.buffer = np.concatenate([self.buffer, pad], axis=1)
+
+        return self._frames()
+
+
+class ISTFTStream(object):
+
+    def __init__(self, n_fft, hop_length):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.window = hann_window(n_fft)
+        self.buffer = None
+        self.norm = np.zeros(n_fft)
+        self.trim = n_fft // 2
+        self.n_sample = 0
+
+    def _emit(self, n_sample):
+        norm = self.norm[:n_sample]
+        nonzero = norm > np.finfo(norm.dtype).tiny
+        wave = self.buffer[:, :n_sample].copy()
+        wave[:, nonzero] /= norm[nonzero]
+
+        self.buffer = self.buffer[:, n_sample:]
+        self.norm = self.norm[n_sample:]
+
+        # drop the centering pad at the head of the signal
+        trim = min(self.trim, wave.shape[1])
+        self.trim -= trim
+        wave = wave[:, trim:]
+        self.n_sample += wave.shape[1]
+
+        return wave.astype(np.float32)
+
+    def push(self, spec):
+        n_frame = spec.shape[2]
+        if self.buffer is None:
+            self.buffer = np.zeros((spec.shape[0], self.n_fft))
+
+        frames = np.fft.irfft(spec, n=self.n_fft, axis=1) * self.window[:, None]
+
+        size = (n_frame - 1) * self.hop_length + self.n_fft
+        if self.buffer.shape[1] < size:
+            pad = size - self.buffer.shape[1]
+            self.buffer = np.pad(self.buffer, ((0, 0), (0, pad)))
+            self.norm = np.pad(self.norm, (0, pad))
+
+        for i in range(n_frame):
+            start = i * self.hop_length
+            self.buffer[:, start:start + self.n_fft] += frames[:, :, i]
+            self.norm[start:start + self.n_fft] += self.window ** 2
+
+        # samples before the next frame's start are complete
+        return self._emit(n_frame * self.hop_length)
+
+    def flush(self):
+        # the centering pad at the tail is dropped: output length is hop * (n_frame - 1)
+        if self.buffer is None:
+            # nothing was pushed; the stems are always stereo
+            return np.zeros((2, 0), dtype=np.float32)
+
+        return self._emit(max(self.buffer.shape[1] - self.n_fft // 2, 0))
@@ -0,0 +1,111 @@
+import multiprocessing
+import time
+
+import torch
+import torch.utils.data
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak memory is then reported as None
+    resource = None
+
+
+def peak_rss_mb(children=False):
+    if resource is None:
+        return None
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class TimedDataset(torch.utils.data.Dataset):
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        # seconds spent in __getitem__, summed over all DataLoader workers
+        self.busy = multiprocessing.Value('d', 0.)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        item = self.dataset[idx]
+        elapsed = time.perf_counter() - start
+        with self.busy.get_lock():
+            self.busy.value += elapsed
+
+        return item
+
+
+class ThroughputMeter(object):
+
+    def __init__(self, device, busy=None, num_workers=0):
+        self.device = device
+        self.busy = busy
+        self.num_workers = num_workers
+
+    def start(self):
+        self.data_wait = 0.
+        self.compute = 0.
+        self.n_sample = 0
+        if self.busy is not None:
+            with self.busy.get_lock():
+                self.busy.value = 0.
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        self.start_time = self.last = time.perf_counter()
+
+    def fetched(self):
+        # called when the DataLoader has handed over a batch
+        now = time.perf_counter()
+        self.data_wait += now - self.last
+        self.last = now
+
+    def computed(self, n_sample):
+        # called after the step, once the loss has been read back from the device
+        now = time.perf_counter()
+        self.compute += now - self.last
+        self.last = now
+        self.n_sample += n_sample
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+
+        utilization = None
+        if self.busy is not None and self.num_workers > 0:
+            utilization = self.busy.value / (elapsed * self.num_workers)
+
+        # both are peaks since the start of the run, the workers' being that
+        # of the largest finished worker
+        stats = {
+            'elapsed': elapsed,
+            'data_wait': self.data_wait,
+            'compute': self.compute,
+            'samples': self.n_sample,
+            'samples_per_second': self.n_sample / elapsed,
+            'worker_utilization': utilization,
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_worker_rss_mb': peak_rss_mb(children=True)
+        }
+        if self.device.type == 'cuda':
+            stats['peak_cuda_mb'] = torch.cuda.max_memory_allocated(self.device) / (1 << 20)
+
+        return stats
+
+
+def format_summary(stats):
+    text = '{:.1f} samples/s, data wait {:.1f}s, compute {:.1f}s'.format(
+        stats['samples_per_second'], stats['data_wait'], stats['compute']
+    )
+    if stats['worker_utilization'] is not None:
+        text += ', workers {:.0%} busy'.format(stats['worker_utilization'])
+    if stats['peak_rss_mb'] is not None:
+        text += ', peak rss {:.0f} MB'.format(stats['peak_rss_mb'])
+    if 'peak_cuda_mb' in stats:
+        text += ', peak cuda {:.0f} MB'.format(stats['peak_cuda_mb'])
+
+    return text
@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+import threading
+from concurrent import futures
+
+import inference
+from lib import stem_cache
+from lib import streaming
+
+
+class SeparationService(object):
+
+    def __init__(
+            self, pretrained_model=inference.DEFAULT_MODEL_PATH, gpu=-1, sr=44100,
+            n_fft=2048, hop_length=1024, batchsize=4, cropsize=256, tta=False,
+            is_complex=False, stream=False, precision='fp32', shards=1,
+            cache_dir=None, cache_size=2 << 30, gate_db=None):
+        self.sr = sr
+        self.tta = tta
+        self.stream = stream
+        self.device = inference.get_device(gpu)
+        self.model = inference.load_model(
+            pretrained_model, n_fft, hop_length, is_complex, self.device,
+            # sharded int8 workers quantize the fp32 weights themselves
+            precision if shards == 1 else 'fp32'
+        )
+        if shards > 1:
+            self.separator = inference.ShardedSeparator(
+                model=self.model,
+                device=self.device,
+                batchsize=batchsize,
+                cropsize=cropsize,
+                precision=precision,
+                gate_db=gate_db,
+                n_shards=shards
+            )
+        else:
+            self.separator = inference.Separator(
+                model=self.model,
+                device=self.device,
+                batchsize=batchsize,
+                cropsize=cropsize,
+                precision=precision,
+                gate_db=gate_db
+            )
+
+        # Full-quality passes behind a preview run on their own separator,
+        # lock and thread, so previews never queue behind them. The weights
+        # are shared; the separator state is not.
+        self.background_separator = inference.Separator(
+            model=self.separator.model,
+            device=self.device,
+            batchsize=batchsize,
+            cropsize=cropsize,
+            precision=precision,
+            gate_db=gate_db
+        )
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = stem_cache.StemCache(cache_dir, cache_size)
+            # everything but the samples that changes the stems
+            self.cache_params = {
+                'weights': stem_cache.hash_file(pretrained_model),
+                'sr': sr,
+                'n_fft': self.model.n_fft,
+                'hop_length': self.model.hop_length,
+                'cropsize': cropsize,
+                'tta': tta,
+                'is_complex': self.model.is_complex,
+                'precision': precision,
+                'stream': stream
+            }
+
+        self._lock = threading.RLock()
+        self._background_lock = threading.RLock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._background_executor = futures.ThreadPoolExecutor(max_workers=1)
+
+    def _cache_key(self, waves, stems, mix_gain, gated):
+        # gate_db only changes the stems on the paths that apply the gate
+        gate_db = self.separator.gate_db if gated else None
+        return stem_cache.make_key(
+            waves, stems=stems, mix_gain=mix_gain, gate_db=gate_db, **self.cache_params
+        )
+
+    def _stems(self, mix_gain):
+        if mix_gain is None:
+            return inference.STEMS, 0
+        return inference.MIX_STEMS, mix_gain
+
+    def separate(self, input_path, output_dir='', basename=None, mix_gain=None, seconds=None, background=False):
+        # With `mix_gain` the karaoke mix (instruments + mix_gain * vocals) is
+        # written in place of the instruments stem. With `seconds` only the
+        # head of the input is separated. `background` runs on the separator
+        # reserved for full-quality passes.
+        stems, mix_gain = self._stems(mix_gain)
+        if basename is None:
+            basename = os.path.splitext(os.path.basename(input_path))[0]
+
+        separator = self.background_separator if background else self.separator
+        lock = self._background_lock if background else self._lock
+        with lock:
+            if self.stream and seconds is None:
+                if self.cache is not None:
+                    key = self._cache_key(
+                        streaming.read_blocks(input_path, self.sr, 30 * self.sr), stems, mix_gain, True
+                    )
+                    paths = self.cache.get(key, output_dir, basename, stems)
+                    if paths is not None:
+                        print('stems of {} found in cache'.format(input_path))
+                        return paths
+
+                paths = inference.separate_file_stream(
+                    separator, input_path,
+                    output_dir=output_dir,
+                    basename=basename,
+                    sr=self.sr,
+                    stems=stems,
+                    mix_gain=mix_gain
+                )
+            else:
+                X, _ = inference.load_wave(input_path, self.sr)
+                if seconds is not None:
+                    X = X[:, :int(seconds * self.sr)]
+
+                if self.cache is not None:
+                    # separate_tta does not gate
+                    key = self._cache_key([X], stems, mix_gain, not self.tta)
+                    paths = self.cache.get(key, output_dir, basename, stems)
+                    if paths is not None:
+                        print('stems of {} found in cache'.format(input_path))
+                        return paths
+
+                paths = inference.separate_wave(
+                    separator, X,
+                    output_dir=output_dir,
+                    basename=basename,
+                    sr=self.sr,
+                    tta=self.tta,
+                    stems=stems,
+                    mix_gain=mix_gain
+                )
+
+            if self.cache is not None:
+                self.cache.put(key, paths, stems)
+
+            return paths
+
+    def separate_many(self, input_paths, output_dir='', mix_gain=None):
+        with self._lock:
+            if self.stream or self.tta:
+                return [
+                    self.separate(input_path, output_dir, mix_gain=mix_gain)
+                    for input_path in input_paths
+                ]
+
+            stems, mix_gain = self._stems(mix_gain)
+
+            if self.cache is None:
+                return inference.separate_files(
+                    self.separator, input_paths,
+                    output_dir=output_dir,
+                    sr=self.sr,
+                    stems=stems,
+                    mix_gain=mix_gain
+                )
+
+            outputs = {}
+            misses = []
+
+            def waves():
+                # cache hits are copied out right away, only misses are separated
+                for input_path in input_paths:
+                    basename = os.path.splitext(os.path.basename(input_path))[0]
+                    X, _ = inference.load_wave(input_path, self.sr)
+                    # separate_many does not gate
+                    key = self._cache_key([X], stems, mix_gain, False)
+                    paths = self.cache.get(key, output_dir, basename, stems)
+                    if paths is None:
+                        misses.append((input_path, key))
+                        yield basename, X
+                    else:
+                        outputs[input_path] = paths
+
+            results = inference.separate_waves(
+                self.separator, waves(), output_dir, self.sr, stems, mix_gain
+            )
+            for (input_path, key), paths in zip(misses, results):
+                self.cache.put(key, paths, stems)
+                outputs[input_path] = paths
+
+            return [outputs[input_path] for input_path in input_paths]
+
+    def separate_staged(self, input_path, output_dir='', basename=None, mix_gain=None):
+        # Full-quality pass into a staging directory under `output_dir`. The
+        # stems already in `output_dir` (e.g. the preview) are left alone
+        # until the caller is done with them and calls promote_staged.
+        if output_dir != '':
+            os.makedirs(output_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix='.separate-', dir=output_dir or '.')
+        try:
+            return self.separate(input_path, staging_dir, basename, mix_gain, background=True)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+    def promote_staged(self, paths, output_dir=''):
+        # Each stem is moved over the existing one with os.replace, so a
+        # reader sees either the old file or the new one, never a partial one.
+        outputs = []
+        try:
+            for path in paths:
+                output_path = os.path.join(output_dir, os.path.basename(path))
+                os.replace(path, output_path)
+                outputs.append(output_path)
+        finally:
+            shutil.rmtree(os.path.dirname(paths[0]), ignore_errors=True)
+
+        return tuple(outputs)
+
+    def submit(self, input_path, output_dir='', basename=None, mix_gain=None):
+        return self._executor.submit(self.separate, input_path, output_dir, basename, mix_gain)
+
+    def submit_many(self, input_paths, output_dir='', mix_gain=None):
+        return self._executor.submit(self.separate_many, input_paths, output_dir, mix_gain)
+
+    def submit_staged(self, input_path, output_dir='', basename=None, mix_gain=None):
+        return self._background_executor.submit(
+            self.separate_staged, input_path, output_dir, basename, mix_gain
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._background_executor.shutdown(wait=True)
+        if isinstance(self.separator, inference.ShardedSeparator):
+            self.separator.close()